@@ -17,12 +17,17 @@ import locale
 import os
 import publicprize.auth.model as pam
 import publicprize.biv as biv
+import publicprize.contest.image as pci
 import publicprize.contest.model as pcm
+import publicprize.db_stats
 import publicprize.controller as ppc
 import publicprize.evc.model as pem
+import publicprize.mail_transport as mail_transport
+import publicprize.recorder as recorder
 import pytz
 import re
 import subprocess
+import sys
 import time
 import urllib.request
 import werkzeug.serving
@@ -41,7 +46,8 @@ class BetterLogger(werkzeug.serving.BaseRequestHandler):
     def _teardown(response):
         """Called before context has been popped"""
         user_state = '""'
-        if 'user.biv_id' in flask.session:
+        # Reading an unloaded session would load it from the store
+        if flask.session.is_loaded and 'user.biv_id' in flask.session:
             user_state = 'l'
             if flask.session['user.is_logged_in']:
                 user_state += 'i'
@@ -125,6 +131,7 @@ def add_sponsor(contest, name, website, input_file):
         logo_type=imghdr.what(None, logo)
         ))
     _add_owner(contest, sponsor_id)
+    pci.derive(logo, imghdr.what(None, logo), 'sponsor_tile')
 
 
 @_MANAGER.command
@@ -172,12 +179,14 @@ def create_evc_contest(json_file):
         pam.BivAlias.alias_name == data['Alias']['name'],
     ).first()
     if a:
+        biv.invalidate_alias(a.alias_name, a.biv_id)
         db.session.delete(a)
         db.session.flush()
     _add_model(pam.BivAlias(
         biv_id=contest_id,
         alias_name=data['Alias']['name'],
     ))
+    biv.invalidate_alias(data['Alias']['name'], contest_id)
 
 
 @_MANAGER.command
@@ -219,6 +228,32 @@ def drop_db(auto_force=False):
             env=e)
 
 
+@_MANAGER.option('-i', '--input_file', help='Recorded requests file')
+@_MANAGER.option('-p', '--path', help='Only requests with path matching regex')
+def dump_requests(input_file, path=None):
+    """Print requests and responses recorded by publicprize.recorder"""
+    for r in recorder.read(input_file):
+        if 'method' not in r:
+            print(r)
+            continue
+        if path and not re.search(path, r['path']):
+            continue
+        print('{} {}{} {:.3f}s'.format(
+            r['method'],
+            r['path'],
+            '?' + r['query'] if r['query'] else '',
+            r.get('duration', 0),
+        ))
+        for k, v in sorted(r['headers'].items()):
+            print('{}: {}'.format(k, v))
+        print(recorder.body(r, 'request_body').decode('utf-8', 'replace'))
+        print(r.get('status'))
+        for k, v in r.get('response_headers') or []:
+            print('{}: {}'.format(k, v))
+        print(recorder.body(r, 'response_body').decode('utf-8', 'replace'))
+        print()
+
+
 @_MANAGER.option('-c', '--contest', help='Contest biv_id')
 def list_nominees(contest):
     """Set contest.field to date."""
@@ -228,10 +263,12 @@ def list_nominees(contest):
     f = open('nominees.csv', 'w', newline='')
     w = csv.writer(f)
     w.writerow(['Contestant', 'Link', 'Submitter', 'Email', 'Phone', 'Address', 'Public?', 'Valid?', 'Id'])
-    for n in pem.E15Nominee.query.select_from(pam.BivAccess).filter(
-            pam.BivAccess.source_biv_id == c.biv_id,
-            pam.BivAccess.target_biv_id == pem.E15Nominee.biv_id,
-        ).all():
+    nominees = pem.E15Nominee.query.select_from(pam.BivAccess).filter(
+        pam.BivAccess.source_biv_id == c.biv_id,
+        pam.BivAccess.target_biv_id == pem.E15Nominee.biv_id,
+    ).all()
+    uris = biv.encode_uris([n.biv_id for n in nominees])
+    for n, biv_uri in zip(nominees, uris):
         submitter = n.submitter()
         w.writerow([
             n.display_name,
@@ -242,7 +279,7 @@ def list_nominees(contest):
             n.contact_address,
             'Y' if n.is_public else 'N',
             'Y' if n.is_valid else 'N',
-            biv.Id(n.biv_id).to_biv_uri(),
+            biv_uri,
         ])
     f.close()
     print('wrote nominees.csv')
@@ -257,17 +294,24 @@ def list_scores(contest, field):
     f = open('scores.csv', 'w', newline='')
     w = csv.writer(f)
     w.writerow(['Contestant', 'Votes', 'Judge Rank', 'URL'])
-    for n in scores:
+    uris = biv.encode_uris([n['biv_id'] for n in scores])
+    for n, biv_uri in zip(scores, uris):
         w.writerow([
             n['display_name'],
             n['votes'],
             n['judge_score'],
-            '2pp.us/' + biv.Id(n['biv_id']).to_biv_uri(),
+            '2pp.us/' + biv_uri,
         ])
     f.close()
     print('wrote scores.csv')
 
 
+@_MANAGER.option('-p', '--port', help='Port to listen on')
+def mail_sink(port='1025'):
+    """Print mail sent to localhost:port; set MAIL_SERVER and MAIL_PORT"""
+    print('listening on 127.0.0.1:{}'.format(port))
+    mail_transport.Sink(port, stream=sys.stdout).serve_forever()
+
 
 @_MANAGER.option('-n', '--nominee', help='Nominee biv_id')
 def nominee_comments(nominee):
@@ -279,7 +323,7 @@ def nominee_comments(nominee):
 
 @_MANAGER.command
 def refresh_founder_avatars():
-    """Download the User.avatar_url and store in Founder.founder_avatar."""
+    """Download the User.avatar_url and store as the Founder's Image."""
     count = 0
     for user in pam.User.query.filter(
             pam.User.avatar_url != None).all():  # noqa
@@ -307,7 +351,7 @@ def register_event_voters(contest, input_file):
     """Load voter emails/phones from a file; invites NOT sent"""
     c = biv.load_obj(contest)
     assert type(c) == pem.E15Contest
-    _add_model(c)
+    valid = []
     with open(input_file) as f:
         for l in f:
             l = l.rstrip()
@@ -315,12 +359,11 @@ def register_event_voters(contest, input_file):
             if err:
                 print('{}: invalid email or phone'.format(l))
             else:
-                vae, created = pem.E15VoteAtEvent.create_unless_exists(c, eop)
-                if created:
-                    _add_model(vae)
-                else:
-                    print('{}: already registered'.format(vae.invite_email_or_phone))
-
+                valid.append(eop)
+    created, existing = pem.E15VoteAtEvent.create_many(c, valid)
+    for eop in existing:
+        print('{}: already registered'.format(eop))
+    print('{} registered'.format(len(created)))
 
 
 @_MANAGER.option('-u', '--user', help='User biv_id or email')
@@ -372,6 +415,28 @@ def remove_sponsor(contest, name):
         print('no sponsor found for name: {}'.format(name))
 
 
+@_MANAGER.option('-c', '--contest', help='Contest biv_id, synthesizes event voting')
+@_MANAGER.option('-i', '--input_file', help='Recorded requests file')
+@_MANAGER.option('-n', '--concurrency', help='Concurrent clients')
+@_MANAGER.option('-p', '--polls', help='Polls per event voter')
+@_MANAGER.option('-l', '--login', action='store_true',
+                 help='Log in each recorded session as a new test user')
+def replay(contest=None, input_file=None, concurrency='10', polls='5',
+           login=False):
+    """Replay recorded or synthesized requests and report latencies"""
+    import publicprize.replay
+    if input_file:
+        sequences = publicprize.replay.recorded_sequences(input_file, login)
+    elif contest:
+        c = biv.load_obj(contest)
+        assert type(c) == pem.E15Contest
+        sequences = publicprize.replay.event_voting_sequences(c, int(polls))
+    else:
+        raise Exception('missing contest or input_file')
+    print(publicprize.replay.report(
+        publicprize.replay.run(sequences, int(concurrency))))
+
+
 @_MANAGER.option('-u', '--user', help='User biv_id or email')
 @_MANAGER.option('-i', '--input_file', help='Image file name')
 def replace_founder_avatar(user, input_file):
@@ -459,6 +524,7 @@ def toggle_nominee_flag(nominee, field):
         '{}.{}: is not boolean {}'.format(n, field, type(n.field))
     setattr(n, field, not v)
     _add_model(n)
+    # The web processes' contest snapshots show it after _SNAPSHOT_TTL
 
 
 @_MANAGER.option('-c', '--contest', help='Contest biv_id')
@@ -597,24 +663,27 @@ def twitter_handle_update(contest, old, new):
         break
 
 
-@_MANAGER.command
-def upgrade_db():
+@_MANAGER.option('-d', '--delete_orphans', action='store_true',
+                 help='Delete votes whose nominee is not in a contest')
+def upgrade_db(delete_orphans=False):
     """Backs up the db and runs an upgrade"""
     import publicprize.db_upgrade
 
     backup_db()
-    for field, date in (
-        ("submission_start", "6/16/2017 12:0:0"),
-        ("submission_end", "9/7/2017 12:0:0"),
-        ("public_voting_start", "9/8/2017 12:0:0"),
-        ("public_voting_end", "9/15/2017 12:0:0"),
-        ("judging_start", "9/27/2017 12:0:0"),
-        ("judging_end", "9/27/2017 19:0:0"),
-    ):
-        set_contest_date_time('esprit-venture-challenge', date, field)
+    deleted = publicprize.db_upgrade.upgrade_vote_contest_biv_id(
+        delete_orphans=delete_orphans)
+    for k in sorted(deleted):
+        print('deleted {} votes: {}'.format(k, deleted[k]))
     db.session.commit()
 
 
+def _add_avatar_image(image):
+    """Adds an Image and its avatar variant, returns the Image's biv_id"""
+    image_type = imghdr.what(None, image)
+    pci.derive(image, image_type, 'avatar')
+    return _add_model(pcm.Image(image_data=image, image_type=image_type))
+
+
 def _add_model(model):
     """Adds a SQLAlchemy model and returns it's biv_id"""
     db.session.add(model)
@@ -700,6 +769,7 @@ def _create_database(is_production=False, is_prompt_forced=False):
                 user_id = _create_user()
                 _add_model(
                     pcm.Vote(
+                        contest_biv_id=contest_id,
                         user=user_id,
                         nominee_biv_id=nominee_id,
                         vote_status='1x',
@@ -716,9 +786,8 @@ def _create_founder(founder):
         founder_desc=founder['founder_desc']
     )
     if 'avatar_filename' in founder:
-        model.founder_avatar = _read_image_from_file(
-            founder['avatar_filename'])
-        model.avatar_type = imghdr.what(None, model.founder_avatar)
+        model.image_biv_id = _add_avatar_image(
+            _read_image_from_file(founder['avatar_filename']))
     return model
 
 
@@ -759,7 +828,7 @@ def _founders_for_user(user, without_avatars=None):
         pam.BivAccess.target_biv_id == pcm.Founder.biv_id,
     )
     if without_avatars:
-        query = query.filter(pcm.Founder.founder_avatar == None)  # noqa
+        query = query.filter(pcm.Founder.image_biv_id == None)  # noqa
     return query.all()
 
 
@@ -847,14 +916,20 @@ def _setup_xxx_ists(c, scores, num, attr_name):
         print(nm.biv_id, nm.display_name)
         setattr(nm, attr_name, True)
         _add_model(nm)
+    # The web processes' contest snapshots show it after _SNAPSHOT_TTL
 
 
 def _update_founder_avatar(founder, image):
-    """Update Founder.founder_avatar."""
+    """Replace the Founder's Image."""
     print("replaced image for founder: {}".format(founder.biv_id))
-    founder.founder_avatar = image
-    founder.avatar_type = imghdr.what(None, image)
+    founder.image_biv_id = _add_avatar_image(image)
     db.session.add(founder)
 
 if __name__ == '__main__':
-    _MANAGER.run()
+    with publicprize.db_stats.collect() as _stats:
+        try:
+            _MANAGER.run()
+        finally:
+            if _stats.count:
+                sys.stderr.write('db_stats: {}\n'.format(
+                    json.dumps(_stats.as_dict())))
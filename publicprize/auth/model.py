@@ -11,6 +11,7 @@ from .. import common
 from .. import controller
 from ..controller import db
 import sqlalchemy
+import sqlalchemy.orm
 import werkzeug.exceptions
 
 class Admin(db.Model, common.ModelWithDates):
@@ -26,14 +27,26 @@ class Admin(db.Model, common.ModelWithDates):
 
     def is_admin():
         """Returns True if the logged in user is an admin."""
-        if not flask.session.get('user.is_logged_in'):
-            return False
-        if Admin.query.select_from(BivAccess).filter(
-            BivAccess.source_biv_id == flask.session['user.biv_id'],
-            BivAccess.target_biv_id == Admin.biv_id
-        ).first():
-            return True
-        return False
+        return Admin.BIV_MARKER in user_roles()
+
+
+class BeakerCache(db.Model):
+    """Sessions stored by session._DatabaseStore, in the format
+    beaker.ext.database used so existing sessions are still valid.
+    Fields:
+        id: primary ID
+        namespace: session id
+        accessed: last saved
+        created: first saved
+        data: pickled dict with the session in 'session'
+    """
+    __tablename__ = 'beaker_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    namespace = db.Column(db.String(255), nullable=False)
+    accessed = db.Column(db.DateTime, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    __table_args__ = (sqlalchemy.UniqueConstraint('namespace'),)
 
 
 class BivAccess(db.Model, common.Model):
@@ -95,3 +108,35 @@ class User(db.Model, common.ModelWithDates):
 Admin.BIV_MARKER = biv.register_marker(10, Admin)
 BivAccess.BIV_MARKER = biv.register_marker(5, BivAccess)
 User.BIV_MARKER = biv.register_marker(6, User)
+
+
+def user_roles():
+    """Returns the models owned by the logged in user, e.g. Admin, Judge, and
+    Registrar, as {biv_marker: set(owner biv_ids)}. Owners are the other
+    sources of the role model, e.g. the contest for a Judge. Computed with one
+    query and cached on flask.g for the rest of the request."""
+    if not flask.session.get('user.is_logged_in'):
+        return {}
+    user_biv_id = int(flask.session['user.biv_id'])
+    cached = getattr(flask.g, '_pp_user_roles', None)
+    if cached and cached[0] == user_biv_id:
+        return cached[1]
+    owner_alias = sqlalchemy.orm.aliased(BivAccess)
+    res = {}
+    for target, owner in db.session.query(
+        BivAccess.target_biv_id,
+        owner_alias.source_biv_id,
+    ).outerjoin(
+        owner_alias,
+        sqlalchemy.and_(
+            owner_alias.target_biv_id == BivAccess.target_biv_id,
+            owner_alias.source_biv_id != BivAccess.source_biv_id,
+        ),
+    ).filter(
+        BivAccess.source_biv_id == user_biv_id,
+    ).all():
+        owners = res.setdefault(biv.Id(target).biv_marker, set())
+        if owner is not None:
+            owners.add(int(owner))
+    flask.g._pp_user_roles = (user_biv_id, res)
+    return res
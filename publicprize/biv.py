@@ -5,8 +5,11 @@
     :license: Apache, see LICENSE for more details.
 """
 
+import collections
 import decimal
 import numconv
+import threading
+import time
 import werkzeug.exceptions
 
 from . import inspect as ppi
@@ -59,12 +62,9 @@ class Id(int):
             i = self.__int__()
             if i in _id_to_alias:
                 return _id_to_alias[i][0]
-            import publicprize.auth.model
-            alias = publicprize.auth.model.BivAlias.query.filter_by(
-                biv_id=i,
-            ).first()
-            if alias:
-                return URI(alias.alias_name)
+            alias_name = _biv_id_to_alias_name(i)
+            if alias_name:
+                return URI(alias_name)
         return URI(self)
 
 
@@ -103,26 +103,35 @@ class URI(str):
         if isinstance(biv_uri_or_id, Id):
             self = super().__new__(cls, cls.__encode(biv_uri_or_id))
             self.__id = biv_uri_or_id
+            self.__int_id = None
             return self
         bu = str(biv_uri_or_id)
         self = super().__new__(cls, bu)
+        self.__int_id = None
         if bu[0] == _ENC_PREFIX:
             self.__id = cls.__decode(bu)
         elif bu in _alias_to_id:
             self.__id = _alias_to_id[bu]
         else:
-            import publicprize.auth.model
-            alias = publicprize.auth.model.BivAlias.query.filter_by(
-                alias_name=bu
-            ).first_or_404()
-            self.__id = Id(alias.biv_id)
+            self.__id = _alias_name_to_biv_id(bu)
         return self
 
     @property
     def biv_id(self):
         """Returns Id for this URI"""
+        if self.__id is None:
+            self.__id = Id(self.__int_id)
         return self.__id
 
+    @classmethod
+    def _from_int(cls, uri, biv_id):
+        """Creates from an encoded uri or alias for biv_id, deferring Id
+        creation"""
+        self = super().__new__(cls, uri)
+        self.__id = None
+        self.__int_id = biv_id
+        return self
+
     @staticmethod
     def __decode(biv_uri):
         bu = biv_uri[1:]
@@ -133,9 +142,108 @@ class URI(str):
 
     @staticmethod
     def __encode(biv_id):
-        bm = _CONV.int2str(biv_id.biv_marker).zfill(_MARKER_ENC_LEN)
-        bi = _CONV.int2str(biv_id.biv_index)
-        return _ENC_PREFIX + bi + bm
+        return _encode(biv_id.biv_index, biv_id.biv_marker)
+
+
+class _AliasCache(object):
+    """Bounded LRU of BivAlias lookups with entries that expire after ttl
+    seconds. None is a valid (negative) value, i.e. "no alias"."""
+
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Removes all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, key):
+        """Removes key if it exists"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key):
+        """Returns (True, value) if key is cached and not expired, else
+        (False, None)"""
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                return False, None
+            if e[1] < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, e[0]
+
+    def set(self, key, value):
+        """Stores value, evicting the least recently used entry if full"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+def cache_alias(alias_name, biv_id):
+    """Caches a BivAlias read in bulk by the caller"""
+    bi = Id(biv_id)
+    _alias_name_cache.set(alias_name, bi)
+    _biv_id_alias_cache.set(int(bi), alias_name)
+
+
+def clear_alias_cache():
+    """Empties the BivAlias lookup caches"""
+    _alias_name_cache.clear()
+    _biv_id_alias_cache.clear()
+
+
+def encode_uris(biv_ids):
+    """Converts biv_ids to URIs (same order) like Id.to_biv_uri.
+
+    Aliases not already cached are resolved with one BivAlias query.
+    """
+    ids = [int(i) for i in biv_ids]
+    aliases = {}
+    misses = set()
+    for i in ids:
+        if i in _id_to_alias:
+            aliases[i] = _id_to_alias[i][0]
+            continue
+        found, alias_name = _biv_id_alias_cache.get(i)
+        if found:
+            aliases[i] = alias_name
+        else:
+            misses.add(i)
+    if misses:
+        import publicprize.auth.model
+        BivAlias = publicprize.auth.model.BivAlias
+        for alias in BivAlias.query.filter(
+            BivAlias.biv_id.in_(misses),
+        ).all():
+            aliases[int(alias.biv_id)] = alias.alias_name
+            _alias_name_cache.set(alias.alias_name, Id(alias.biv_id))
+        for i in misses:
+            _biv_id_alias_cache.set(i, aliases.setdefault(i, None))
+    res = []
+    for i in ids:
+        assert MARKER_MODULUS < i <= _MAX_ID, str(i) + ': range'
+        res.append(URI._from_int(
+            aliases[i] or _encode(i // MARKER_MODULUS, i % MARKER_MODULUS),
+            i,
+        ))
+    return res
+
+
+def invalidate_alias(alias_name=None, biv_id=None):
+    """Removes cached lookups for alias_name and/or biv_id. Call this
+    whenever a BivAlias is inserted or deleted."""
+    if alias_name is not None:
+        _alias_name_cache.discard(alias_name)
+    if biv_id is not None:
+        _biv_id_alias_cache.discard(int(biv_id))
 
 
 def load_obj(biv_uri):
@@ -150,6 +258,11 @@ def load_obj(biv_uri):
     return _marker_to_class[bi.biv_marker].load_biv_obj(bi)
 
 
+def registered_classes():
+    """Model classes registered with register_marker"""
+    return list(_marker_to_class.values())
+
+
 def register_alias(uri, biv_id):
     """Registers biv_id with non-encoded uri"""
     assert uri not in _alias_to_id, uri + ': exists'
@@ -173,6 +286,44 @@ def register_marker(biv_marker, cls):
     _marker_to_class[biv_marker] = cls
     return Marker(biv_marker)
 
+def _alias_name_to_biv_id(alias_name):
+    """Returns Id for alias_name from BivAlias (cached) or aborts with 404"""
+    found, bi = _alias_name_cache.get(alias_name)
+    if not found:
+        import publicprize.auth.model
+        alias = publicprize.auth.model.BivAlias.query.filter_by(
+            alias_name=alias_name,
+        ).first()
+        bi = Id(alias.biv_id) if alias else None
+        _alias_name_cache.set(alias_name, bi)
+        if bi is not None:
+            _biv_id_alias_cache.set(int(bi), alias_name)
+    if bi is None:
+        pp_t('{}: alias not found', [alias_name])
+        werkzeug.exceptions.abort(404)
+    return bi
+
+
+def _biv_id_to_alias_name(biv_id):
+    """Returns the BivAlias.alias_name for biv_id (cached) or None"""
+    found, alias_name = _biv_id_alias_cache.get(biv_id)
+    if not found:
+        import publicprize.auth.model
+        alias = publicprize.auth.model.BivAlias.query.filter_by(
+            biv_id=biv_id,
+        ).first()
+        alias_name = alias.alias_name if alias else None
+        _biv_id_alias_cache.set(biv_id, alias_name)
+        if alias_name is not None:
+            _alias_name_cache.set(alias_name, Id(biv_id))
+    return alias_name
+
+
+def _encode(biv_index, biv_marker):
+    """Encoded uri for the parts of an Id"""
+    return _ENC_PREFIX + _CONV.int2str(biv_index) + _MARKER_ENC[biv_marker]
+
+
 _CONV = numconv.NumConv(radix=62, alphabet=numconv.BASE62)
 _ENC_PREFIX = '_'
 _IDEMPOTENT_URI = None
@@ -181,6 +332,15 @@ _MAX_INDEX = _MAX_ID // MARKER_MODULUS
 # We reserve 900 and above for versioning and growth
 _MAX_MARKER = MARKER_MODULUS - 101
 _MARKER_ENC_LEN = len(_CONV.int2str(_MAX_MARKER))
+# Index is the marker; 0 is invalid so is left empty
+_MARKER_ENC = [''] + [
+    _CONV.int2str(m).zfill(_MARKER_ENC_LEN) for m in range(1, _MAX_MARKER + 1)]
 _marker_to_class = {}
 _alias_to_id = {}
 _id_to_alias = {}
+# BivAlias lookups are mostly misses (nominees have no alias) so the
+# id cache holds many negative entries; TTL bounds staleness across processes
+_ALIAS_CACHE_SIZE = 10000
+_ALIAS_CACHE_TTL = 300
+_alias_name_cache = _AliasCache(_ALIAS_CACHE_SIZE, _ALIAS_CACHE_TTL)
+_biv_id_alias_cache = _AliasCache(_ALIAS_CACHE_SIZE, _ALIAS_CACHE_TTL)
@@ -5,15 +5,12 @@
     :license: Apache, see LICENSE for more details.
 """
 
-import decimal
 import flask
 import functools
-import inspect
 import locale
 import re
 import socket
 import sqlalchemy
-import sys
 import urllib.parse
 import urllib.request
 import werkzeug.exceptions
@@ -23,6 +20,18 @@ from . import biv
 from .debug import pp_t
 
 
+def absolute_uri(uri):
+    """Absolute URI for uri, a path such as format_uri returns"""
+    return flask.url_for(
+        '_route',
+        path=uri,
+        _external=True,
+        _scheme=(
+            'http' if ppc.app().config['PUBLICPRIZE']['TEST_MODE']
+            else 'https')
+    )
+
+
 def decorator_login_required(func):
     """Method decorator which requires a logged in user."""
     @functools.wraps(func)
@@ -87,14 +96,7 @@ class Model(object):
     @property
     def task_class(self):
         """Corresponding Task class for this Model"""
-        if hasattr(self, '__default_task_class'):
-            return self.__default_task_class
-        module_name = self.__module__
-        module = sys.modules[
-            re.sub(ppc._MODEL_MODULE_RE, ppc._TASK_MODULE, module_name)]
-        self.__default_task_class = getattr(module, self.__class__.__name__)
-        assert inspect.isclass(self.__default_task_class)
-        return self.__default_task_class
+        return ppc.task_class(self.__class__)
 
     def assert_action_uri(self, action_uri):
         """Verify action_uri is a valid action on self"""
@@ -102,14 +104,7 @@ class Model(object):
 
     def format_absolute_uri(self, action=None):
         """Create an absolute URI for a model action."""
-        return flask.url_for(
-            '_route',
-            path=self.format_uri(action),
-            _external=True,
-            _scheme=(
-                'http' if ppc.app().config['PUBLICPRIZE']['TEST_MODE']
-                else 'https')
-        )
+        return absolute_uri(self.format_uri(action))
 
     def format_uri(
             self, action_uri=None, path_info=None, query=None,
@@ -145,20 +140,11 @@ class Model(object):
     def _asdict(self):
         """Called by flask.jsonify to serialize the model."""
         # simplejson must be install for this to get called
-        res = {}
-        for key in self.__mapper__.c.keys():
-            v = getattr(self, key)
-            #TODO(pjm): ugly
-            if re.search(key, 'biv_id'):
-                v = biv.Id(v).to_biv_uri()
-            elif isinstance(v, decimal.Decimal):
-                v = str(v)
-            elif isinstance(v, biv.Id):
-                v = biv_id.to_biv_uri()
-            elif isinstance(v, bytes):
-                continue
-            res[key] = v
-        return res
+        return serialize_many([self])[0]
+
+    def _asdict_update(self, res):
+        """Add computed values to res, the serialized model"""
+        pass
 
     def __repr__(self):
         try:
@@ -279,6 +265,45 @@ def normalize_url(url):
     return url
 
 
+def reserve_biv_ids(model, count):
+    """Returns count new biv_ids from model's biv_id sequence in one query.
+
+    Use for multi-row inserts which can't get the ids from flush()."""
+    if count <= 0:
+        return []
+    return [r[0] for r in ppc.db.session.execute(
+        sqlalchemy.text(
+            'SELECT nextval(:seq) FROM generate_series(1, :count)'),
+        dict(seq=model.__table__.c.biv_id.default.name, count=count),
+    ).fetchall()]
+
+
+def serialize_many(rows):
+    """Serializes Models for jsonify like _asdict. biv_ids are converted to
+    URIs in one batch."""
+    res = []
+    uri_rows = []
+    for row in rows:
+        fields, deferred = _serializer(row.__class__)
+        # deferred columns which weren't requested are not loaded
+        unloaded = sqlalchemy.inspect(row).unloaded if deferred else ()
+        v = {}
+        for key, convert in fields:
+            if key in unloaded:
+                continue
+            if convert is _TO_URI:
+                uri_rows.append(v)
+                v[key] = getattr(row, key)
+            else:
+                v[key] = convert(getattr(row, key))
+        res.append(v)
+    for v, uri in zip(uri_rows, biv.encode_uris([v['biv_id'] for v in uri_rows])):
+        v['biv_id'] = uri
+    for row, v in zip(rows, res):
+        row._asdict_update(v)
+    return res
+
+
 def safe_unicode(str):
     """Strip non-ascii characters out of a unicode string."""
     return str.encode("ascii", "replace").decode("utf-8")
@@ -294,3 +319,40 @@ def summary_text(text):
     if match:
         return match.group(1)
     return text
+
+
+def _decimal_to_str(v):
+    return None if v is None else str(v)
+
+
+def _serializer(model_class):
+    """Returns (key, converter) for each field and if any are deferred"""
+    try:
+        return _serializers[model_class]
+    except KeyError:
+        pass
+    fields = []
+    deferred = False
+    for prop in model_class.__mapper__.column_attrs:
+        key = prop.key
+        if isinstance(prop.columns[0].type, sqlalchemy.LargeBinary):
+            continue
+        deferred = deferred or prop.deferred
+        if key == 'biv_id':
+            convert = _TO_URI
+        elif isinstance(prop.columns[0].type, sqlalchemy.Numeric):
+            convert = _decimal_to_str
+        else:
+            convert = _identity
+        fields.append((key, convert))
+    res = _serializers[model_class] = (tuple(fields), deferred)
+    return res
+
+
+def _identity(v):
+    return v
+
+
+# Marker for biv_id which serialize_many converts in a batch
+_TO_URI = object()
+_serializers = {}
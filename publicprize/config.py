@@ -39,6 +39,14 @@ class Config(object):
         if PUBLICPRIZE.get(k, None) is None:
             PUBLICPRIZE[k] = PUBLICPRIZE['TEST_MODE']
     MAIL_SUPPRESS_SEND = PUBLICPRIZE['MAIL_SUPPRESS_SEND']
+    # cookie, memory, or database, see session.py
+    if PUBLICPRIZE.get('SESSION_TYPE') is None:
+        PUBLICPRIZE['SESSION_TYPE'] = 'database'
+    if PUBLICPRIZE.get('SESSION_TTL') is None:
+        PUBLICPRIZE['SESSION_TTL'] = 365 * 24 * 60 * 60
+    # resized images, see contest/image.py
+    if PUBLICPRIZE.get('IMAGE_DIR') is None:
+        PUBLICPRIZE['IMAGE_DIR'] = os.path.join(os.getcwd(), 'run/images')
     import paypalrestsdk
     paypalrestsdk.configure(PUBLICPRIZE['PAYPAL'])
     SECRET_KEY = PUBLICPRIZE['SECRET_KEY']
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+""" Delivery of images stored in LargeBinary columns.
+
+An image's md5 is computed by the database once per process and used as
+its ETag, so conditional GETs are answered without reading the image.
+Clients revalidate on every use. Recently sent images are kept in a
+bounded LRU.
+
+Resized VARIANTS are created with Pillow, if installed, and stored on disk
+in IMAGE_DIR by the original image's md5.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import collections
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import flask
+import sqlalchemy
+import werkzeug.exceptions
+
+from ..debug import pp_t
+from .. import controller as ppc
+
+# Derived images: name to ((width, height), is_cropped). Uncropped
+# variants fit within the size and keep their aspect ratio.
+VARIANTS = {
+    'avatar': ((64, 64), True),
+    'sponsor_tile': ((255, 178), False),
+}
+
+
+def derive(data, image_type, variant):
+    """Writes variant of the image data to the image store unless it exists.
+    Returns the variant's path or None if Pillow is not installed."""
+    path = _variant_path(hashlib.md5(data).hexdigest(), image_type, variant)
+    if os.path.exists(path):
+        return path
+    try:
+        import PIL.Image
+        import PIL.ImageOps
+    except ImportError:
+        pp_t('Pillow not installed, variants not created')
+        return None
+    size, is_cropped = VARIANTS[variant]
+    image = PIL.Image.open(io.BytesIO(data))
+    if image_type == 'jpeg' and image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    if is_cropped:
+        image = PIL.ImageOps.fit(image, size, PIL.Image.ANTIALIAS)
+    else:
+        image.thumbnail(size, PIL.Image.ANTIALIAS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Other threads and processes may be writing the same variant, so
+    # each writes its own file and the complete file is renamed
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        suffix='.tmp',
+        delete=False,
+    ) as f:
+        try:
+            image.save(f, image_type)
+        except Exception:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+    pp_t('{}: created {}', [variant, path])
+    return path
+
+
+def send(biv_obj, data_column, type_column, variant=None):
+    """Response for the image in biv_obj's data_column, resized to variant
+    if supplied. Returns 304 if the client has the current version."""
+    key = (int(biv_obj.biv_id), data_column)
+    etag, image_type = _image_metadata(key, biv_obj, data_column, type_column)
+    blob_key = key + (etag,)
+    mimetype = 'image/{}'.format(image_type)
+    path = None
+    if variant:
+        path = _variant_path(etag, image_type, variant)
+        etag += '-' + variant
+    if flask.request.if_none_match.contains(etag):
+        res = flask.Response(status=304)
+    elif path and (os.path.exists(path) or derive(
+            _image_data(blob_key, biv_obj, data_column),
+            image_type,
+            variant,
+    )):
+        # uwsgi sends the file with sendfile(2)
+        res = flask.send_file(path, mimetype=mimetype, add_etags=False)
+    else:
+        res = flask.Response(
+            _image_data(blob_key, biv_obj, data_column),
+            mimetype=mimetype,
+        )
+    res.set_etag(etag)
+    res.headers['Cache-Control'] = _REVALIDATE
+    return res
+
+
+def _image_data(key, biv_obj, data_column):
+    with _lock:
+        res = _blobs.get(key)
+        if res is not None:
+            _blobs.move_to_end(key)
+            return res
+    model = type(biv_obj)
+    if data_column in sqlalchemy.inspect(biv_obj).unloaded:
+        # deferred, so fetch just the column
+        res = ppc.db.session.query(getattr(model, data_column)).filter(
+            model.biv_id == biv_obj.biv_id).scalar()
+    else:
+        res = getattr(biv_obj, data_column)
+    if res is None:
+        werkzeug.exceptions.abort(404)
+    res = bytes(res)
+    if len(res) <= _MAX_CACHED_IMAGE:
+        with _lock:
+            if key not in _blobs:
+                _blobs[key] = res
+                _stats['bytes'] += len(res)
+            while _stats['bytes'] > _MAX_CACHE_BYTES:
+                _, v = _blobs.popitem(last=False)
+                _stats['bytes'] -= len(v)
+    return res
+
+
+def _variant_path(etag, image_type, variant):
+    """Variants are stored by the original image's md5"""
+    return os.path.join(
+        ppc.app().config['PUBLICPRIZE']['IMAGE_DIR'],
+        etag[:2],
+        '{}-{}.{}'.format(etag, variant, image_type),
+    )
+
+
+def _image_metadata(key, biv_obj, data_column, type_column):
+    now = time.monotonic()
+    with _lock:
+        res = _metadata.get(key)
+    if not res or res[0] <= now:
+        model = type(biv_obj)
+        row = ppc.db.session.query(
+            sqlalchemy.func.md5(getattr(model, data_column)),
+            getattr(model, type_column),
+        ).filter(model.biv_id == biv_obj.biv_id).first()
+        # "no image" is cached too
+        res = (now + _METADATA_TTL,) + (tuple(row) if row else (None, None))
+        pp_t('{}: etag={}', [key, res[1]])
+        with _lock:
+            _metadata[key] = res
+    if res[1] is None:
+        werkzeug.exceptions.abort(404)
+    return res[1:]
+
+
+# Total bytes of images kept in memory
+_MAX_CACHE_BYTES = 32 * 1024 * 1024
+# Larger images are not kept in memory
+_MAX_CACHED_IMAGE = 1024 * 1024
+# Seconds before the md5 is recomputed, which bounds how long another
+# process serves a replaced image
+_METADATA_TTL = 300
+_REVALIDATE = 'public, max-age=0, must-revalidate'
+_blobs = collections.OrderedDict()
+_lock = threading.Lock()
+_metadata = {}
+_stats = {'bytes': 0}
@@ -11,6 +11,7 @@ import math
 import pytz
 import re
 import random
+import sqlalchemy
 import sqlalchemy.orm
 import string
 import werkzeug.exceptions
@@ -93,15 +94,7 @@ class ContestBase(common.ModelWithDates):
             return False
         if self.is_expired() and not is_override_expired:
             return False
-        access_alias = sqlalchemy.orm.aliased(pam.BivAccess)
-        if clazz.query.select_from(pam.BivAccess, access_alias).filter(
-            pam.BivAccess.source_biv_id == self.biv_id,
-            pam.BivAccess.target_biv_id == clazz.biv_id,
-            pam.BivAccess.target_biv_id == access_alias.target_biv_id,
-            access_alias.source_biv_id == flask.session['user.biv_id']
-        ).first():
-            return True
-        return False
+        return int(self.biv_id) in pam.user_roles().get(clazz.BIV_MARKER, ())
 
 
 class Founder(db.Model, common.ModelWithDates):
@@ -130,7 +123,8 @@ class Image(db.Model, common.Model):
         db.Sequence('image_s', start=1004, increment=1000),
         primary_key=True
     )
-    image_data = db.Column(db.LargeBinary)
+    # only loaded when the image is sent, see image.py
+    image_data = sqlalchemy.orm.deferred(db.Column(db.LargeBinary), group='blob')
     image_type = db.Column(db.Enum('gif', 'png', 'jpeg', name='image_type'))
 
 
@@ -150,6 +144,42 @@ class Judge(db.Model, common.ModelWithDates):
     judge_company = db.Column(db.String(100))
     judge_title = db.Column(db.String(100))
 
+    def judging_progress(contest, nominee_ids):
+        """Returns (user biv_id, display_name, user_email, rank_count) for
+        each of contest's judges in one query. rank_count is the number of
+        the judge's JudgeRanks for nominee_ids."""
+        access_alias = sqlalchemy.orm.aliased(pam.BivAccess)
+        rank_filter = JudgeRank.nominee_biv_id.in_(list(nominee_ids)) \
+            if nominee_ids else sqlalchemy.false()
+        return db.session.query(
+            pam.User.biv_id,
+            pam.User.display_name,
+            pam.User.user_email,
+            sqlalchemy.func.count(JudgeRank.nominee_biv_id),
+        ).select_from(pam.User).join(
+            pam.BivAccess,
+            pam.BivAccess.source_biv_id == pam.User.biv_id,
+        ).join(
+            Judge,
+            pam.BivAccess.target_biv_id == Judge.biv_id,
+        ).join(
+            access_alias,
+            sqlalchemy.and_(
+                access_alias.source_biv_id == contest.biv_id,
+                access_alias.target_biv_id == Judge.biv_id,
+            ),
+        ).outerjoin(
+            JudgeRank,
+            sqlalchemy.and_(
+                JudgeRank.judge_biv_id == pam.User.biv_id,
+                rank_filter,
+            ),
+        ).group_by(
+            pam.User.biv_id,
+            pam.User.display_name,
+            pam.User.user_email,
+        ).all()
+
     def judge_users_for_contest(contest):
         access_alias = sqlalchemy.orm.aliased(pam.BivAccess)
         return pam.User.query.select_from(
@@ -192,7 +222,8 @@ class NomineeBase(common.ModelWithDates):
     is_public = db.Column(db.Boolean, nullable=False)
 
     def delete_all_founders(self):
-        founders = [f.biv_id for f in Founder.query.select_from(pam.BivAccess).filter(
+        founders = [r[0] for r in db.session.query(Founder.biv_id).select_from(
+            pam.BivAccess).filter(
             pam.BivAccess.source_biv_id == self.biv_id,
             pam.BivAccess.target_biv_id == Founder.biv_id
         ).all()]
@@ -212,6 +243,8 @@ class NomineeBase(common.ModelWithDates):
         founders = Founder.query.select_from(pam.BivAccess).filter(
             pam.BivAccess.source_biv_id == self.biv_id,
             pam.BivAccess.target_biv_id == Founder.biv_id
+        ).options(
+            sqlalchemy.orm.load_only('biv_id', 'display_name', 'founder_desc'),
         ).all()
         res = []
         for founder in founders:
@@ -275,7 +308,7 @@ class Sponsor(db.Model, common.ModelWithDates):
     website = db.Column(db.String(100))
     image_biv_id = db.Column(db.Numeric(18))
     #TODO(pjm): remove these fields after next release
-    sponsor_logo = db.Column(db.LargeBinary)
+    sponsor_logo = sqlalchemy.orm.deferred(db.Column(db.LargeBinary), group='blob')
     logo_type = db.Column(db.Enum('gif', 'png', 'jpeg', name='logo_type'))
 
     def get_sponsors_for_biv_id(biv_id, randomize):
@@ -296,6 +329,7 @@ class Vote(db.Model, common.ModelWithDates):
         db.Sequence('vote_s', start=1014, increment=1000),
         primary_key=True
     )
+    contest_biv_id = db.Column(db.Numeric(18), nullable=False)
     user = db.Column(
         db.Numeric(18),
         db.ForeignKey('user_t.biv_id'),
@@ -315,6 +349,8 @@ class Vote(db.Model, common.ModelWithDates):
     nominee_biv_id = db.Column(db.Numeric(18), nullable=False)
     twitter_handle = db.Column(db.String(100))
     vote_status = db.Column(db.Enum('invalid', '1x', '2x', name='vote_status'), nullable=False)
+    # One vote per user per contest
+    __table_args__ = (sqlalchemy.UniqueConstraint('contest_biv_id', 'user'),)
 
 
 def _test_role(contest, clazz):
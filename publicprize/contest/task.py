@@ -9,8 +9,7 @@ from .. import common
 from .. import controller
 from ..controller import db
 from ..debug import pp_t
-import flask
-import io
+from . import image as pci
 
 
 class Founder(controller.Task):
@@ -18,16 +17,23 @@ class Founder(controller.Task):
     pass
 
 
+class Image(controller.Task):
+    """Image actions"""
+    def action_index(biv_obj):
+        """The image"""
+        return pci.send(biv_obj, 'image_data', 'image_type')
+
+    def action_avatar(biv_obj):
+        """The image cropped to an avatar square"""
+        return pci.send(biv_obj, 'image_data', 'image_type', 'avatar')
+
+
 class Sponsor(controller.Task):
     """Sponsor actions"""
     def action_sponsor_logo(biv_obj):
         """Sponsor logo image"""
-        return _send_image_data(biv_obj, 'sponsor_logo', 'logo_type')
-
+        return pci.send(biv_obj, 'sponsor_logo', 'logo_type')
 
-def _send_image_data(biv_obj, data, data_type):
-    # see SEND_FILE_MAX_AGE_DEFAULT config value
-    return flask.send_file(
-        io.BytesIO(getattr(biv_obj, data)),
-        'image/{}'.format(getattr(biv_obj, data_type))
-    )
+    def action_sponsor_tile(biv_obj):
+        """Sponsor logo sized for the sponsor list"""
+        return pci.send(biv_obj, 'sponsor_logo', 'logo_type', 'sponsor_tile')
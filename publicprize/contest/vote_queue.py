@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+""" Write-behind queue for public Votes.
+
+Requests validate a vote and submit() it. A writer thread (one per process)
+inserts queued votes in batches with one multi-row INSERT and commit, so
+concurrent voters share a transaction. submit() waits for the commit so an
+accepted vote is durable when the request returns. If a batch fails, its
+votes are retried one at a time.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import os
+import queue
+import sqlalchemy
+import threading
+import time
+import werkzeug.exceptions
+
+from ..debug import pp_t
+from .. import common
+from .. import controller as ppc
+from . import model as pcm
+
+# Votes waiting to be written; submit() writes directly when full
+_MAX_DEPTH = 5000
+# Votes per INSERT
+_MAX_BATCH = 500
+# Seconds the writer waits for more votes before flushing a batch
+_BATCH_WAIT = 0.01
+# Seconds submit() waits for the commit
+_COMMIT_TIMEOUT = 10
+
+_INSERT = '''INSERT INTO {table}
+    (biv_id, contest_biv_id, "user", nominee_biv_id, vote_status)
+    VALUES {values}
+    ON CONFLICT (contest_biv_id, "user") DO NOTHING
+    RETURNING contest_biv_id, "user"'''
+
+
+class _Item(object):
+    """A vote on the queue"""
+
+    def __init__(self, contest_biv_id, user_biv_id, nominee_biv_id, log_data):
+        self.contest_biv_id = contest_biv_id
+        self.done = threading.Event()
+        self.error = None
+        self.key = (int(contest_biv_id), int(user_biv_id))
+        self.log_data = log_data
+        self.nominee_biv_id = nominee_biv_id
+        self.user_biv_id = user_biv_id
+        self.was_written = False
+
+
+def stats():
+    """Returns counters for monitoring this process's queue"""
+    with _lock:
+        res = dict(_stats)
+    res['depth'] = _queue.qsize() if _queue else 0
+    return res
+
+
+def submit(contest_biv_id, user_biv_id, nominee_biv_id, log_data):
+    """Queues a vote and waits for it to be committed. Returns True if the
+    vote was written, False if the user already voted in the contest.
+    Aborts with 503 if the commit takes longer than _COMMIT_TIMEOUT.
+
+    Args:
+        log_data (dict): logged with the vote
+    """
+    item = _Item(contest_biv_id, user_biv_id, nominee_biv_id, log_data)
+    with _lock:
+        if item.key in _pending:
+            _stats['rejected'] += 1
+            return False
+        _pending.add(item.key)
+    try:
+        q = _writer_queue()
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            with _lock:
+                _stats['sync_writes'] += 1
+            # Committed by the request
+            _count([item], _write([item]))
+            return item.was_written
+        if not item.done.wait(_COMMIT_TIMEOUT):
+            ppc.app().logger.error('vote not committed in {}s: {}'.format(
+                _COMMIT_TIMEOUT, item.log_data))
+            # The vote may not be written, so the client must retry
+            werkzeug.exceptions.abort(503)
+        if item.error:
+            raise item.error
+        return item.was_written
+    finally:
+        with _lock:
+            _pending.discard(item.key)
+
+
+def _flush(batch):
+    """Writes and commits batch in the writer's app context. If the batch
+    fails, its votes are written one at a time so only the failing votes
+    get the error."""
+    start = time.monotonic()
+    with ppc.app().app_context():
+        try:
+            if not _commit(batch):
+                ppc.app().logger.error(
+                    'vote batch failed, retrying votes: {}'.format(
+                        batch[0].error))
+                with _lock:
+                    _stats['failed_batches'] += 1
+                for item in batch:
+                    if not _commit([item]):
+                        ppc.app().logger.error('vote failed: {} {}'.format(
+                            item.log_data, item.error))
+        finally:
+            ppc.db.session.remove()
+    elapsed = time.monotonic() - start
+    with _lock:
+        _stats['batches'] += 1
+        _stats['last_flush_seconds'] = elapsed
+        _stats['max_flush_seconds'] = max(_stats['max_flush_seconds'], elapsed)
+        _stats['last_batch_size'] = len(batch)
+    for item in batch:
+        item.done.set()
+
+
+def _commit(batch):
+    """Writes and commits batch. Returns False and sets the items' error
+    if the transaction fails."""
+    try:
+        n = _write(batch)
+        ppc.db.session.commit()
+    except Exception as e:
+        ppc.db.session.rollback()
+        for item in batch:
+            item.error = e
+            item.was_written = False
+        return False
+    for item in batch:
+        item.error = None
+    _count(batch, n)
+    return True
+
+
+def _count(batch, written):
+    """Updates the stats with the written and rejected votes in batch"""
+    with _lock:
+        _stats['rejected'] += len(batch) - written
+        _stats['written'] += written
+
+
+def _run(q):
+    """Writer thread: collects up to _MAX_BATCH votes and flushes them"""
+    while True:
+        batch = [q.get()]
+        deadline = time.monotonic() + _BATCH_WAIT
+        while len(batch) < _MAX_BATCH:
+            try:
+                batch.append(
+                    q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        _flush(batch)
+
+
+def _write(batch):
+    """Inserts the votes in batch. The unique (contest_biv_id, user) index
+    skips users who already voted. Returns the number written."""
+    params = {}
+    values = []
+    biv_ids = common.reserve_biv_ids(pcm.Vote, len(batch))
+    for i, (biv_id, item) in enumerate(zip(biv_ids, batch)):
+        values.append(
+            '(:biv_id{i}, :contest_biv_id{i}, :user{i}, :nominee_biv_id{i},'
+            " '1x')".format(i=i),
+        )
+        params.update({
+            'biv_id{}'.format(i): biv_id,
+            'contest_biv_id{}'.format(i): item.contest_biv_id,
+            'user{}'.format(i): item.user_biv_id,
+            'nominee_biv_id{}'.format(i): item.nominee_biv_id,
+        })
+    written = set(
+        (int(r[0]), int(r[1])) for r in ppc.db.session.execute(
+            sqlalchemy.text(_INSERT.format(
+                table=pcm.Vote.__table__.name,
+                values=', '.join(values),
+            )),
+            params,
+        ).fetchall()
+    )
+    for item in batch:
+        if item.key in written:
+            item.was_written = True
+            ppc.app().logger.warn('user vote: {}'.format(item.log_data))
+        else:
+            pp_t('{}: already voted', [item.user_biv_id])
+    return len(written)
+
+
+def _writer_queue():
+    """Queue for this process, starting the writer thread after a fork"""
+    global _queue, _queue_pid
+    with _lock:
+        if _queue_pid != os.getpid():
+            _queue = queue.Queue(maxsize=_MAX_DEPTH)
+            _queue_pid = os.getpid()
+            t = threading.Thread(target=_run, args=(_queue,), name='vote_queue')
+            t.daemon = True
+            t.start()
+        return _queue
+
+
+_lock = threading.Lock()
+_pending = set()
+_queue = None
+_queue_pid = None
+_stats = dict(
+    batches=0,
+    failed_batches=0,
+    last_batch_size=0,
+    last_flush_seconds=None,
+    max_flush_seconds=0,
+    rejected=0,
+    sync_writes=0,
+    written=0,
+)
@@ -13,11 +13,10 @@ import os
 import os.path
 import re
 import sys
+import types
 
-from beaker.middleware import SessionMiddleware
 from flask_sqlalchemy import SQLAlchemy
 import flask
-import flask.sessions
 import flask_mail
 import flask_mobility
 import urllib.parse
@@ -25,7 +24,11 @@ import werkzeug.exceptions
 
 from . import biv
 from . import config
+from . import db_stats
 from . import debug
+from . import mail_transport
+from . import recorder
+from . import session
 from .debug import pp_t
 
 db = None
@@ -45,6 +48,9 @@ def init():
         module_prefix = 'publicprize.' + name + '.'
         importlib.import_module(module_prefix + _MODEL_MODULE)
         importlib.import_module(module_prefix + _TASK_MODULE)
+    for model_class in biv.registered_classes():
+        if _find_task_class(model_class):
+            _model_actions(model_class)
 
 
 def mail():
@@ -52,76 +58,101 @@ def mail():
     return _mail
 
 
+def mail_pool():
+    """Pooled connections for mail(), see mail_transport.py"""
+    return _mail_pool
+
+
 class Task(object):
     """Provides the actions for a Model"""
 
     def __init__(self):
         pass
 
-class BeakerSession(flask.sessions.SessionInterface):
-    """Session management replacement for standard flask session.
-    Stores session info in the application database in the beaker_cache
-    table."""
-    def __init__(self, app=None):
-        if app is not None:
-            self.init_app(app)
-        else:
-            self.app = None
-
-    def init_app(self, app):
-        """Register the session manager with flask."""
-        lock_dir = os.path.join(os.getcwd(), 'run/lock')
-        if not os.path.exists(lock_dir):
-            os.makedirs(lock_dir)
-        app.wsgi_app = SessionMiddleware(
-            app.wsgi_app,
-            {
-                'session.type': 'ext:database',
-                'session.url': app.config['SQLALCHEMY_DATABASE_URI'],
-                'session.lock_dir': lock_dir,
-                # the cookie key
-                'session.key': 'pp',
-                'session.cookie_expires': False
-            }
-        )
-        app.session_interface = self
-
-    def open_session(self, app, request):
-        """Called by flask to create the session"""
-        return request.environ.get('beaker.session')
-
-    def save_session(self, app, session, response):
-        """Called by flask to save the session"""
-        session.save()
-
 _ACTION_METHOD_PREFIX = 'action_'
 _DEFAULT_ACTION_NAME = 'index'
 _TASK_MODULE = 'task'
 _MODEL_MODULE = 'model'
 _MODEL_MODULE_RE = r'(?<=\.)' + _MODEL_MODULE + r'$'
+# Model class to {action_uri: function}, see _model_actions
+_actions = types.MappingProxyType({})
+_model_to_task = types.MappingProxyType({})
+_pub_obj = None
 _app = flask.Flask(__name__, template_folder='.')
 _app.config.from_object(config.Config)
 debug.init(_app)
-BeakerSession(_app)
+recorder.init(_app)
+session.SessionInterface(_app)
 _mail = flask_mail.Mail(_app)
+_mail_pool = mail_transport.Pool(_mail)
 flask_mobility.Mobility(_app)
+# Before SQLAlchemy so db_stats' teardown runs after the commit
+db_stats.init(_app)
 db = SQLAlchemy(_app, session_options=dict(autoflush=True))
 
 
+def task_class(model_class):
+    """Returns the Task class for model_class"""
+    res = _model_to_task.get(model_class)
+    if res is None:
+        _model_actions(model_class)
+        res = _model_to_task[model_class]
+    return res
+
+
 def _action_uri_to_function(name, biv_obj):
     """Returns the task function for the uri."""
-    pp_t('name={}, biv_obj={}', [name, biv_obj])
-    name = re.sub(r'\W', '_', name)
-    name = _ACTION_METHOD_PREFIX + name
-    if not hasattr(biv_obj.task_class, name):
-        pp_t('{}: does not exist in {}', [name, biv_obj])
-        werkzeug.exceptions.abort(404)
-    func = getattr(biv_obj.task_class, name)
-    assert inspect.isfunction(func), name + ': action not a function in ' + biv_obj
-    pp_t('{}.{}.{}', [biv_obj.task_class.__module__, biv_obj.task_class.__name__, name])
+    actions = _model_actions(type(biv_obj))
+    func = actions.get(name)
+    if func is None:
+        # Any non-word character maps to '_', not just '-'
+        func = actions.get(re.sub(r'\W', '_', name))
+        if func is None:
+            pp_t('{}: does not exist in {}', [name, biv_obj])
+            werkzeug.exceptions.abort(404)
     return func
 
 
+def _find_task_class(model_class):
+    """Task class with same name as model_class in the sibling task module"""
+    module = sys.modules.get(
+        re.sub(_MODEL_MODULE_RE, _TASK_MODULE, model_class.__module__))
+    res = getattr(module, model_class.__name__, None)
+    if res is not None:
+        assert inspect.isclass(res), str(res) + ': task not a class'
+    return res
+
+
+def _model_actions(model_class):
+    """Returns the action_uri to function map for model_class, building it
+    (and the task class map) on first use."""
+    global _actions, _model_to_task
+    res = _actions.get(model_class)
+    if res is not None:
+        return res
+    tc = _find_task_class(model_class)
+    assert tc, str(model_class) + ': no task class'
+    res = {}
+    for name in dir(tc):
+        if not name.startswith(_ACTION_METHOD_PREFIX):
+            continue
+        func = getattr(tc, name)
+        assert inspect.isfunction(func), \
+            name + ': action not a function in ' + str(tc)
+        uri = name[len(_ACTION_METHOD_PREFIX):]
+        res[uri] = func
+        res[uri.replace('_', '-')] = func
+    res = types.MappingProxyType(res)
+    # Replace (not mutate) the maps so concurrent readers are safe
+    m = dict(_model_to_task)
+    m[model_class] = tc
+    _model_to_task = types.MappingProxyType(m)
+    a = dict(_actions)
+    a[model_class] = res
+    _actions = types.MappingProxyType(a)
+    return res
+
+
 def _dispatch_action(name, biv_obj):
     """Returns the task function for the uri. Returns the "index" action if
     there is no uri."""
@@ -149,16 +180,19 @@ def _parse_path(path):
 
 def _register_globals():
     """Load globals onto flask's 'g' variable"""
-    import publicprize.general.model
-    flask.g.pub_obj = publicprize.general.model.General.load_biv_obj(
-        publicprize.general.model.PUB_OBJ)
+    global _pub_obj
+    if _pub_obj is None:
+        # General is stateless so one instance serves all requests
+        import publicprize.general.model
+        _pub_obj = publicprize.general.model.General.load_biv_obj(
+            publicprize.general.model.PUB_OBJ)
+    flask.g.pub_obj = _pub_obj
 
 
 @_app.route("/<path:path>", methods=('GET', 'POST'))
 def _route(path):
     """Routes the uri to the appropriate biv_obj"""
     biv_obj, action, path_info = _parse_path(path)
-    pp_t('user_id={} is_logged_in={}', [flask.session.get('user.biv_id'), flask.session.get('user.is_logged_in')])
     _register_globals()
     flask.request.pp_request = {
         'biv_obj': biv_obj,
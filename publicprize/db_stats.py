@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Per-request database statistics and N+1 detection.
+
+Every statement executed by an Engine is counted and timed in the Stats
+being collected by the current thread. A statement executed N_PLUS_ONE
+or more times with different parameters is a suspected N+1 query (a
+query in a loop). For each request, stats are returned in the X-PP-DB
+header in test mode and logged in production.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+import flask
+import sqlalchemy.engine
+import sqlalchemy.event
+
+# Executions of a statement with different parameters flagged as N+1
+N_PLUS_ONE = 5
+
+
+class Stats(object):
+    """Statements executed while collecting"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # statement to [count, set of parameter hashes]
+        self._statements = {}
+
+    def add(self, statement, parameters, seconds):
+        self.count += 1
+        self.seconds += seconds
+        s = self._statements.get(statement)
+        if not s:
+            s = self._statements[statement] = [0, set()]
+        s[0] += 1
+        s[1].add(hash(repr(parameters)))
+
+    def as_dict(self):
+        """Summary for logging"""
+        return {
+            'queries': self.count,
+            'db_ms': round(self.seconds * 1000, 1),
+            'n_plus_one': [
+                {'count': c, 'statement': s[:200]} for s, c in self.suspects()
+            ],
+        }
+
+    def header(self):
+        """Summary for the X-PP-DB header"""
+        return 'queries={}; db_ms={:.1f}; n_plus_one={}'.format(
+            self.count, self.seconds * 1000, len(self.suspects()))
+
+    def suspects(self):
+        """(statement, count) executed N_PLUS_ONE or more times with
+        different parameters"""
+        return [
+            (s, v[0]) for s, v in self._statements.items()
+            if v[0] >= N_PLUS_ONE and len(v[1]) > 1
+        ]
+
+
+@contextlib.contextmanager
+def collect():
+    """Yields Stats of the statements executed by this thread in the
+    block. Collections may be nested."""
+    res = Stats()
+    active = _active()
+    active.append(res)
+    try:
+        yield res
+    finally:
+        active.remove(res)
+
+
+def init(app):
+    """Collect Stats for all requests"""
+    # Listeners are global, so only added by the first init
+    for name, fn in (
+        ('before_cursor_execute', _before_execute),
+        ('after_cursor_execute', _after_execute),
+    ):
+        if not sqlalchemy.event.contains(sqlalchemy.engine.Engine, name, fn):
+            sqlalchemy.event.listen(sqlalchemy.engine.Engine, name, fn)
+    is_test = app.config['PUBLICPRIZE']['TEST_MODE']
+
+    @app.before_request
+    def _before_request():
+        flask.g.pp_db_stats = Stats()
+        flask.g.pp_db_stats_path = flask.request.path
+        _active().append(flask.g.pp_db_stats)
+
+    @app.after_request
+    def _after_request(response):
+        # Statements executed by teardowns (e.g. the commit) are too late
+        # for the header, but they are logged
+        stats = getattr(flask.g, 'pp_db_stats', None)
+        if stats and is_test:
+            response.headers['X-PP-DB'] = stats.header()
+        return response
+
+    # Flask calls teardown_appcontext functions in the reverse order of
+    # registration, after the teardown_request functions. init is called
+    # before SQLAlchemy registers its teardown (which commits), so this
+    # runs last and counts the commit's statements.
+    @app.teardown_appcontext
+    def _teardown_appcontext(exc):
+        stats = getattr(flask.g, 'pp_db_stats', None)
+        if not stats:
+            return
+        _active().remove(stats)
+        if is_test or not stats.count:
+            return
+        d = stats.as_dict()
+        d['path'] = flask.g.pp_db_stats_path
+        if d['n_plus_one']:
+            app.logger.warn('db_stats: {}'.format(json.dumps(d)))
+        else:
+            app.logger.info('db_stats: {}'.format(json.dumps(d)))
+
+
+def _active():
+    try:
+        return _local.active
+    except AttributeError:
+        _local.active = []
+        return _local.active
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    active = getattr(_local, 'active', None)
+    if not active:
+        return
+    start = getattr(context, '_pp_db_stats_start', None)
+    seconds = time.time() - start if start else 0.0
+    for stats in active:
+        stats.add(statement, parameters, seconds)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(_local, 'active', None):
+        context._pp_db_stats_start = time.time()
+
+
+_local = threading.local()
@@ -7,6 +7,8 @@
 
 from sqlalchemy import sql
 from .auth import model as pam
+from .contest import model as pcm
+from .evc import model as pem
 from . import controller as ppc
 
 
@@ -62,3 +64,64 @@ def upgrade_lowercase_user_email():
     for user in users:
         user.user_email = user.user_email.lower()
         ppc.db.session.add(user)
+
+
+def upgrade_vote_contest_biv_id(delete_orphans=False):
+    """Adds Vote.contest_biv_id, set from the nominee's contest, and the
+    unique (contest_biv_id, user) constraint in one transaction.
+
+    A user keeps one vote per contest: a vote for a public nominee before
+    one for a hidden nominee, then the earliest. The others are deleted.
+    Votes whose nominee isn't in an E15Contest (orphans) fail the upgrade
+    and are listed, unless delete_orphans. Returns the deleted biv_ids:
+    dict(orphans, duplicates).
+    """
+    engine = ppc.db.get_engine(ppc.app())
+    params = {
+        'access': pam.BivAccess.__table__.description,
+        'contest': pem.E15Contest.__table__.description,
+        'nominee': pem.E15Nominee.__table__.description,
+        'table': pcm.Vote.__table__.description,
+    }
+    res = {}
+    with engine.begin() as conn:
+        conn.execute(sql.text(
+            'ALTER TABLE {table} ADD COLUMN contest_biv_id NUMERIC(18)'.format(
+                **params)))
+        conn.execute(sql.text('''
+            UPDATE {table} SET contest_biv_id = {access}.source_biv_id
+            FROM {access}, {contest}
+            WHERE {access}.target_biv_id = {table}.nominee_biv_id
+            AND {access}.source_biv_id = {contest}.biv_id
+        '''.format(**params)))
+        orphans = [r[0] for r in conn.execute(sql.text(
+            'SELECT biv_id FROM {table} WHERE contest_biv_id IS NULL'
+            ' ORDER BY biv_id'.format(**params)))]
+        # Raising rolls back the transaction
+        assert delete_orphans or not orphans, \
+            'votes not in an E15Contest (use delete_orphans): {}'.format(orphans)
+        res['orphans'] = [r[0] for r in conn.execute(sql.text(
+            'DELETE FROM {table} WHERE contest_biv_id IS NULL'
+            ' RETURNING biv_id'.format(**params)))]
+        res['duplicates'] = [r[0] for r in conn.execute(sql.text('''
+            DELETE FROM {table} WHERE biv_id IN (
+                SELECT biv_id FROM (
+                    SELECT v.biv_id, row_number() OVER (
+                        PARTITION BY v.contest_biv_id, v."user"
+                        ORDER BY COALESCE(n.is_public, FALSE) DESC,
+                            v.creation_date_time, v.biv_id
+                    ) AS rank
+                    FROM {table} v
+                    LEFT JOIN {nominee} n ON n.biv_id = v.nominee_biv_id
+                ) ranked
+                WHERE rank > 1
+            )
+            RETURNING biv_id
+        '''.format(**params)))]
+        conn.execute(sql.text(
+            'ALTER TABLE {table} ALTER COLUMN contest_biv_id SET NOT NULL'.format(
+                **params)))
+        conn.execute(sql.text(
+            'ALTER TABLE {table} ADD UNIQUE (contest_biv_id, "user")'.format(
+                **params)))
+    return res
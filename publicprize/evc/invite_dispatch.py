@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+""" Background dispatch of E15VoteAtEvent voting links.
+
+start() collects the invites which are due in the admin's request and
+returns immediately. A coordinator thread hands the invites to a bounded
+pool of sender threads (one pool per process). Email is sent on pooled
+SMTP connections (see mail_transport.py), and each sender keeps its own
+Twilio client. Sends on a channel (email, sms) are spaced to stay under
+the provider's rate limit, and failed sends are retried with exponential
+backoff. invites_sent is incremented in batches with one UPDATE per batch.
+
+A job is claimed with a Postgres advisory lock on the contest's biv_id,
+held on a dedicated connection until the job finishes, so only one
+thread in one process sends a contest's invites. The lock is released if
+the process dies. Jobs' counters live in the process which started them.
+progress() also returns the persisted counts, which are the same in every
+process.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import concurrent.futures
+import os
+import smtplib
+import sqlalchemy
+import threading
+import time
+
+from ..debug import pp_t
+from .. import biv
+from .. import common
+from .. import controller as ppc
+from . import model as pem
+
+
+class _Channel(object):
+    """Spaces sends on a channel to at most per_second"""
+
+    def __init__(self, name, per_second):
+        self.name = name
+        self._interval = 1.0 / per_second
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self._interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class _Job(object):
+    """Invites being sent for one contest"""
+
+    def __init__(self, contest_biv_id, contest_name, invites, claim):
+        self.claim = claim
+        self.contest_biv_id = int(contest_biv_id)
+        self.contest_name = contest_name
+        # (biv_id, email_or_phone, uri)
+        self.invites = invites
+        self.stats = dict(
+            errors=[],
+            failed=0,
+            finished=None,
+            persisted=0,
+            retries=0,
+            sent=0,
+            started=time.time(),
+            total=len(invites),
+        )
+
+    def as_dict(self):
+        with _lock:
+            res = dict(self.stats)
+        res['errors'] = list(res['errors'])
+        return res
+
+
+def progress(contest_biv_id):
+    """Counters of this process's job for the contest (None if there isn't
+    one) and the persisted counts"""
+    job = _jobs.get(int(contest_biv_id))
+    T = pem.E15VoteAtEvent
+    row = ppc.db.session.query(
+        sqlalchemy.func.count(T.biv_id),
+        sqlalchemy.func.count(sqlalchemy.case([(T.invites_sent > 0, 1)])),
+    ).filter(T.contest_biv_id == contest_biv_id).one()
+    return {
+        'job': job.as_dict() if job else None,
+        'invited': row[1],
+        'voters': row[0],
+    }
+
+
+def start(contest, force):
+    """Starts sending the contest's invites which are due (see
+    E15VoteAtEvent.is_invite_due) unless a job is already running for the
+    contest in any process. Returns progress()."""
+    claim = _claim(contest.biv_id)
+    if not claim:
+        pp_t('{}: job running', [contest.biv_id])
+        return progress(contest.biv_id)
+    try:
+        due = [
+            (vae.biv_id, vae.invite_email_or_phone)
+            for vae in pem.E15VoteAtEvent.query.filter_by(
+                contest_biv_id=contest.biv_id,
+            ).all()
+            if vae.is_invite_due(force)
+        ]
+        uris = biv.encode_uris([biv_id for biv_id, _ in due])
+        invites = [
+            (biv_id, to, common.absolute_uri('/' + uri))
+            for (biv_id, to), uri in zip(due, uris)
+        ]
+        job = _Job(contest.biv_id, contest.display_name, invites, claim)
+        with _lock:
+            _jobs[job.contest_biv_id] = job
+        t = threading.Thread(
+            target=_run, args=(job,), name='invite_dispatch'
+        )
+        t.daemon = True
+        t.start()
+    except Exception:
+        _release(contest.biv_id, claim)
+        raise
+    return progress(contest.biv_id)
+
+
+def _claim(contest_biv_id):
+    """Connection holding the contest's lock, or None if another job
+    holds it"""
+    c = ppc.db.engine.connect()
+    try:
+        if c.execute(
+            _statement('SELECT pg_try_advisory_lock(:k)'),
+            k=int(contest_biv_id),
+        ).scalar():
+            return c
+    except Exception:
+        c.close()
+        raise
+    c.close()
+    return None
+
+
+def _executor():
+    """Sender pool for this process, created after a fork"""
+    global _pool, _pool_pid
+    with _lock:
+        if _pool_pid != os.getpid():
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=_SENDERS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _is_permanent(e):
+    """Retrying won't help: bad address or number"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    # twilio.rest.exceptions.TwilioRestException
+    status = getattr(e, 'status', None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+
+def _persist(job, biv_ids):
+    """Increments invites_sent for biv_ids in one UPDATE"""
+    if not biv_ids:
+        return
+    T = pem.E15VoteAtEvent
+    with ppc.app().app_context():
+        try:
+            T.query.filter(T.biv_id.in_(biv_ids)).update(
+                {T.invites_sent: T.invites_sent + 1},
+                synchronize_session=False,
+            )
+            ppc.db.session.commit()
+        except Exception:
+            ppc.db.session.rollback()
+            ppc.app().logger.exception(
+                '{}: invites_sent not updated'.format(job.contest_biv_id))
+            return
+        finally:
+            ppc.db.session.remove()
+    with _lock:
+        job.stats['persisted'] += len(biv_ids)
+
+
+def _run(job):
+    """Coordinator: sends job's invites in the pool and persists the
+    sends in batches"""
+    pool = _executor()
+    futures = [pool.submit(_send, job, i) for i in job.invites]
+    sent = []
+    try:
+        for f in concurrent.futures.as_completed(futures):
+            biv_id = f.result()
+            if biv_id is None:
+                continue
+            sent.append(biv_id)
+            if len(sent) >= _PERSIST_BATCH:
+                _persist(job, sent)
+                sent = []
+    finally:
+        _persist(job, sent)
+        with _lock:
+            job.stats['finished'] = time.time()
+        _release(job.contest_biv_id, job.claim)
+        ppc.app().logger.warn('invites: contest={} {}'.format(
+            job.contest_biv_id, job.as_dict()))
+
+
+def _release(contest_biv_id, claim):
+    """Unlocks the contest and closes claim (returning it to the pool
+    doesn't end the lock)"""
+    try:
+        claim.execute(
+            _statement('SELECT pg_advisory_unlock(:k)'),
+            k=int(contest_biv_id),
+        )
+    except Exception:
+        # Discarding the connection ends its session, which releases
+        # the lock
+        claim.invalidate()
+        ppc.app().logger.exception(
+            '{}: invite lock not released'.format(contest_biv_id))
+    finally:
+        claim.close()
+
+
+def _send(job, invite):
+    """Sends invite, retrying with backoff. Returns its biv_id if it was
+    sent, else None."""
+    biv_id, to, uri = invite
+    channel = _channels['email' if pem.is_email(to) else 'sms']
+    for attempt in range(_MAX_ATTEMPTS):
+        channel.wait()
+        try:
+            with ppc.app().app_context():
+                pem.send_invite_message(
+                    to,
+                    job.contest_name,
+                    uri,
+                    sms_client=_sms() if channel.name == 'sms' else None,
+                )
+            with _lock:
+                job.stats['sent'] += 1
+            return biv_id
+        except Exception as e:
+            if _is_permanent(e) or attempt + 1 >= _MAX_ATTEMPTS:
+                ppc.app().logger.warn('invite failed: to={} error={}'.format(to, e))
+                with _lock:
+                    job.stats['failed'] += 1
+                    job.stats['errors'] = (
+                        job.stats['errors'] + ['{}: {}'.format(to, e)]
+                    )[-_MAX_ERRORS:]
+                return None
+            pp_t('to={} attempt={} error={}', [to, attempt, e])
+            with _lock:
+                job.stats['retries'] += 1
+            time.sleep(_BACKOFF * 2 ** attempt)
+
+
+def _sms():
+    """This sender's Twilio client"""
+    c = getattr(_local, 'sms', None)
+    if not c:
+        c = _local.sms = pem.sms_client_create()
+    return c
+
+
+def _statement(sql):
+    """sql committed when executed, so claim isn't left idle in a
+    transaction while the job runs"""
+    return sqlalchemy.text(sql).execution_options(autocommit=True)
+
+
+# Seconds before the first retry; doubles with each attempt
+_BACKOFF = 0.5
+_MAX_ATTEMPTS = 4
+# Errors kept in a job's counters
+_MAX_ERRORS = 20
+# Sends per invites_sent UPDATE
+_PERSIST_BATCH = 50
+# Sender threads per process
+_SENDERS = 8
+# Sends per second: a typical SMTP relay's limit and Twilio's limit for a
+# short code or messaging service
+_channels = {
+    'email': _Channel('email', 20),
+    'sms': _Channel('sms', 10),
+}
+_jobs = {}
+_local = threading.local()
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
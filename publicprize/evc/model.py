@@ -4,12 +4,17 @@
     :copyright: Copyright (c) 2014 Bivio Software, Inc.  All Rights Reserved.
     :license: Apache, see LICENSE for more details.
 """
+import collections
 import decimal
 import flask
 import random
 import re
+import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
 import string
+import threading
+import time
 import werkzeug.exceptions
 from ..debug import pp_t
 from .. import biv
@@ -48,6 +53,43 @@ def is_email(v):
     return '@' in v
 
 
+def send_invite_message(to, contest_name, uri, sms_client=None):
+    """Emails or texts the voting link uri to the invitee. Email is sent
+    on a pooled connection. Senders may pass a Twilio client to reuse it."""
+    pp_cfg = ppc.app().config['PUBLICPRIZE']
+    assert pp_cfg['TEST_MODE'] or not re.search('/localhost|/127', uri), \
+        'uri={}: uri contains local host'
+    pp_t('to={} uri={}', [to, uri])
+    msg_args = dict(
+        contest=contest_name,
+        uri=uri,
+    )
+    if pp_cfg['MAIL_SUPPRESS_SEND']:
+        pp_t('MAIL_SUPPRESS_SEND=True')
+    if is_email(to):
+        import flask_mail
+        msg = flask_mail.Message(
+            subject=_SEND_INVITE_MAIL_SUBJECT.format(**msg_args),
+            sender=(contest_name, pp_cfg['SUPPORT_EMAIL']),
+            recipients=[to],
+            body=_SEND_INVITE_MAIL_BODY.format(**msg_args),
+        )
+        ppc.mail_pool().send(msg)
+    elif not pp_cfg['MAIL_SUPPRESS_SEND']:
+        (sms_client or sms_client_create()).sms.messages.create(
+            to=to,
+            from_=pp_cfg['TWILIO']['from'],
+            body=_SEND_INVITE_SMS_BODY.format(**msg_args),
+        )
+
+
+def sms_client_create():
+    """Twilio client for the configured account"""
+    import twilio.rest
+    return twilio.rest.TwilioRestClient(
+        **ppc.app().config['PUBLICPRIZE']['TWILIO']['auth'])
+
+
 def validate_email_or_phone(value):
     import pyisemail
     v = re.sub(r'\s+', '', value or '')
@@ -63,6 +105,50 @@ def validate_email_or_phone(value):
     return None, 'invalid phone'
 
 
+# Seconds a snapshot is used before it is rebuilt; bounds staleness for
+# changes made by other processes (e.g. manage.py setup_finalists)
+_SNAPSHOT_TTL = 15
+
+_snapshots = {}
+
+_snapshot_versions = {}
+
+# Session.info key of contests invalidated when the transaction commits
+_SNAPSHOT_INVALIDATIONS = 'pp_snapshot_invalidations'
+
+# Session.info key of event votes added to the caches when the transaction
+# commits
+_EVENT_VOTES = 'pp_event_votes'
+
+# Seconds an E15ScoreTally's vote counts are reused
+_SCORE_TALLY_TTL = 10
+
+_score_tallies = {}
+
+# Seconds an E15EventTally is used before it is rebuilt; bounds how long
+# votes in other processes are uncounted
+_EVENT_TALLY_TTL = 2
+
+_event_tallies = {}
+
+# Voters per page returned by admin_event_votes
+_EVENT_VOTES_PAGE = 500
+
+# Seconds an E15VoterIndex is used before it is rebuilt; bounds how long
+# votes and registrations in other processes are unseen
+_VOTER_INDEX_TTL = 15
+
+_voter_indexes = {}
+
+_voter_index_lock = threading.Lock()
+
+# Rows per multi-row INSERT by E15VoteAtEvent.create_many
+_INSERT_BATCH = 1000
+
+# Rows fetched per round trip by admin_review_votes
+_VOTE_REVIEW_BATCH = 500
+
+
 def _datetime_column():
     return db.Column(db.DateTime(timezone=False), nullable=False)
 
@@ -86,14 +172,15 @@ class E15Contest(db.Model, pcm.ContestBase):
     submission_start = _datetime_column()
 
     def contest_info(self):
-        winner = self._winner_biv_id()
+        snapshot = self.snapshot()
+        winner = snapshot.winner_biv_id
         # TODO: check to make sure show*/is* aren't conflicting (one second overlap)
         #    need to detect transtions. If there are no finalists, but showFinalists, then
         #    compute finalists. Probably just want this on any contest page.
-        semiFinalistCount = self._count(E15Nominee.is_semi_finalist)
-        finalistCount = self._count(E15Nominee.is_finalist)
+        semiFinalistCount = snapshot.semi_finalist_count
+        finalistCount = len(snapshot.finalists)
         return {
-            'contestantCount': len(self.public_nominees()),
+            'contestantCount': len(snapshot.public_nominees),
             'displayName': self.display_name,
             'finalistCount': finalistCount,
             'isEventRegistration': ppdatetime.now_in_range(self.submission_start, self.event_voting_end),
@@ -173,93 +260,304 @@ class E15Contest(db.Model, pcm.ContestBase):
             E15Nominee.is_semi_finalist == True,
         ).all()
 
-    def tally_all_scores(self):
-        res = []
-        total_votes = 0
-        total_rank_scores = 0
-        for nominee in self.public_nominees():
-            ranks = nominee.get_judge_ranks()
-            vote_score = nominee.tally_votes()
-            total_votes += vote_score
-            rank_score = nominee.tally_judge_ranks()
-            total_rank_scores += rank_score
-            res.append({
-                'biv_id': nominee.biv_id,
-                'display_name': nominee.display_name,
-                'judge_ranks': '( {} )'.format(', '.join(map(str, ranks))),
-                'votes': vote_score,
-                'judge_score': rank_score,
-            })
+    def admin_review_votes(self, before=None, limit=None):
+        """Yields the public votes, newest first, with their user and
+        nominee from one query streamed with a server-side cursor.
+
+        Args:
+            before (int): only votes with smaller biv_ids (keyset paging)
+            limit (int): maximum number of votes
+        """
+        query = db.session.query(
+            pcm.Vote.biv_id,
+            pcm.Vote.creation_date_time,
+            pam.User.display_name,
+            pam.User.user_email,
+            pcm.Vote.twitter_handle,
+            E15Nominee.display_name,
+            pcm.Vote.vote_status,
+        ).join(
+            pam.User,
+            pam.User.biv_id == pcm.Vote.user,
+        ).join(
+            E15Nominee,
+            E15Nominee.biv_id == pcm.Vote.nominee_biv_id,
+        ).filter(
+            pcm.Vote.contest_biv_id == self.biv_id,
+            E15Nominee.is_public == True,
+        )
+        if before is not None:
+            query = query.filter(pcm.Vote.biv_id < before)
+        query = query.order_by(pcm.Vote.biv_id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        for r in query.yield_per(_VOTE_REVIEW_BATCH):
+            yield {
+                'biv_id': r[0],
+                'creation_date_time': r[1],
+                'user_display_name': '{} ({})'.format(r[2], r[3]),
+                'twitter_handle': r[4],
+                'nominee_display_name': r[5],
+                'vote_status': r[6],
+            }
+
+    def admin_event_votes(self, after=None, limit=None):
+        """Returns event_vote_counts and a page of registered voters with
+        their votes, ordered by invite_email_or_phone. after is set to the
+        value for the next page.
+
+        Args:
+            after (str): biv_uri of the previous page's last voter
+            limit (int): maximum number of voters (at most _EVENT_VOTES_PAGE)
+        """
+        limit = max(1, min(limit or _EVENT_VOTES_PAGE, _EVENT_VOTES_PAGE))
+        s = self.snapshot()
+        names = dict(zip(
+            s.finalist_ids,
+            (f['display_name'] for f in s.finalists),
+        ))
+        query = db.session.query(
+            E15VoteAtEvent.biv_id,
+            E15VoteAtEvent.invite_email_or_phone,
+            E15VoteAtEvent.nominee_biv_id,
+        ).filter(
+            E15VoteAtEvent.contest_biv_id == self.biv_id,
+        )
+        if after:
+            # Keyset on (invite_email_or_phone, biv_id), which is unique
+            after_id = int(biv.URI(after).biv_id)
+            last = db.session.query(
+                E15VoteAtEvent.invite_email_or_phone,
+            ).filter(
+                E15VoteAtEvent.biv_id == after_id,
+            ).as_scalar()
+            query = query.filter(
+                sqlalchemy.tuple_(
+                    E15VoteAtEvent.invite_email_or_phone,
+                    E15VoteAtEvent.biv_id,
+                ) > sqlalchemy.tuple_(last, after_id),
+            )
+        votes = [
+            dict(
+                # Voters' aliases are their invite nonces, which mustn't
+                # be shown
+                biv_id=biv.Id(r[0]).to_biv_uri(use_alias=False),
+                invite_email_or_phone=r[1],
+                nominee=names.get(r[2], '') if r[2] else '',
+            ) for r in query.order_by(
+                E15VoteAtEvent.invite_email_or_phone,
+                E15VoteAtEvent.biv_id,
+            ).limit(limit)
+        ]
+        res = self.event_vote_counts()
+        res['votes'] = votes
+        res['after'] = votes[-1]['biv_id'] if len(votes) == limit else None
         return res
 
-    def admin_event_votes(self):
-        nominees = {}
-        for f in self.get_finalists():
-            nominees[f.biv_id] = dict(
-                display_name=f.display_name,
-                count=0,
-            )
-        votes = []
-        total_votes = 0
-        total_votes_used = 0
-        for vae in E15VoteAtEvent.query.filter(
-             E15VoteAtEvent.contest_biv_id == self.biv_id,
-        ).order_by(
-            E15VoteAtEvent.invite_email_or_phone,
-        ).all():
-            v = dict(invite_email_or_phone=vae.invite_email_or_phone, nominee='')
-            total_votes += 1
-            if vae.nominee_biv_id:
-                total_votes_used += 1
-                n = nominees[vae.nominee_biv_id]
-                n['count'] += 1
-                v['nominee'] = n['display_name']
-            votes.append(v)
+    def event_vote_counts(self):
+        """Returns the finalists' event vote counts and totals from this
+        process's E15EventTally"""
+        t = E15EventTally.get(self.biv_id)
+        s = self.snapshot()
+        with t.lock:
+            nominees = [
+                dict(
+                    biv_id=f['biv_id'],
+                    display_name=f['display_name'],
+                    count=t.counts.get(int(i), 0),
+                ) for i, f in zip(s.finalist_ids, s.finalists)
+            ]
+            total_votes_used = sum(t.counts.values())
         return dict(
-            nominees=sorted(
-                nominees.values(),
-                key=lambda x: x['count'],
-                reverse=True,
-            ),
-            total_votes=total_votes,
-            total_votes_used=total_votes_used,
-            votes=votes,
             contest=self.display_name,
+            nominees=sorted(nominees, key=lambda x: x['count'], reverse=True),
+            total_votes=t.total,
+            total_votes_used=total_votes_used,
         )
 
-    def tally_all_scores(self):
+    def snapshot(self):
+        """Returns the cached E15ContestSnapshot, building it if it is missing,
+        invalidated, or older than _SNAPSHOT_TTL seconds"""
+        k = int(self.biv_id)
+        version = _snapshot_versions.get(k, 0)
+        res = _snapshots.get(k)
+        if res is None or res.version != version \
+           or res.created + _SNAPSHOT_TTL < time.monotonic():
+            res = E15ContestSnapshot(self, version)
+            _snapshots[k] = res
+        return res
+
+    def tally_all_scores(self, cached=False):
+        """Returns vote and judge scores for each public nominee.
+
+        Args:
+            cached (bool): reuse this process's vote tally if it is less
+                than _SCORE_TALLY_TTL seconds old
+        """
+        k = int(self.biv_id)
+        t = _score_tallies.get(k) if cached else None
+        if t is None:
+            t = E15ScoreTally(self.biv_id)
+            if cached:
+                _score_tallies[k] = t
+        return t.scores()
+
+
+class E15ScoreTally(object):
+    """Computes the vote and judge rank scores for all public nominees of a
+    contest with grouped queries. scores() may be called repeatedly; the
+    vote tally is reused for _SCORE_TALLY_TTL seconds unless the public
+    nominees changed. Votes commit in a different order than their biv_ids
+    are assigned, so the tally is always recounted in full.
+    """
+
+    def __init__(self, contest_biv_id):
+        self.contest_biv_id = contest_biv_id
+        self._created = None
+        self._lock = threading.Lock()
+        self._nominees = None
+        self._votes = None
+
+    def scores(self):
+        """Returns list of dicts: biv_id, display_name, judge_ranks, votes,
+        judge_score"""
+        with self._lock:
+            return self._scores()
+
+    def _scores(self):
+        nominees = dict(db.session.query(
+            E15Nominee.biv_id,
+            E15Nominee.display_name,
+        ).select_from(pam.BivAccess).filter(
+            pam.BivAccess.source_biv_id == self.contest_biv_id,
+            pam.BivAccess.target_biv_id == E15Nominee.biv_id,
+            E15Nominee.is_public == True,
+        ).all())
+        if nominees != self._nominees \
+           or self._created + _SCORE_TALLY_TTL < time.monotonic():
+            self._nominees = nominees
+            self._tally_votes()
+        ranks = dict((k, []) for k in nominees)
+        for nominee_biv_id, judge_rank in db.session.query(
+            pcm.JudgeRank.nominee_biv_id,
+            pcm.JudgeRank.judge_rank,
+        ).filter(
+            pcm.JudgeRank.nominee_biv_id.in_(list(nominees)),
+        ).all():
+            ranks[nominee_biv_id].append(judge_rank)
         res = []
-        total_votes = 0
-        total_rank_scores = 0
-        for nominee in self.public_nominees():
-            ranks = nominee.get_judge_ranks()
-            vote_score = nominee.tally_votes()
-            total_votes += vote_score
-            rank_score = nominee.tally_judge_ranks()
-            total_rank_scores += rank_score
+        for biv_id, display_name in nominees.items():
+            r = ranks[biv_id]
             res.append({
-                'biv_id': nominee.biv_id,
-                'display_name': nominee.display_name,
-                'judge_ranks': '( {} )'.format(', '.join(map(str, ranks))),
-                'votes': vote_score,
-                'judge_score': rank_score,
+                'biv_id': biv_id,
+                'display_name': display_name,
+                'judge_ranks': '( {} )'.format(', '.join(map(str, r))),
+                'votes': self._votes.get(biv_id, 0),
+                'judge_score': sum(
+                    (pcm.JudgeRank.MAX_RANKS + 1) - x for x in r),
             })
         return res
 
-    def _count(self, field):
-        return E15Nominee.query.select_from(pam.BivAccess).filter(
-            pam.BivAccess.source_biv_id == self.biv_id,
-            pam.BivAccess.target_biv_id == E15Nominee.biv_id,
-            field == True,
-        ).count()
+    def _tally_votes(self):
+        self._created = time.monotonic()
+        self._votes = dict(
+            (nominee_biv_id, int(score))
+            for nominee_biv_id, score in db.session.query(
+                pcm.Vote.nominee_biv_id,
+                sqlalchemy.func.sum(_vote_score()),
+            ).filter(
+                pcm.Vote.nominee_biv_id.in_(list(self._nominees)),
+            ).group_by(
+                pcm.Vote.nominee_biv_id,
+            ).all()
+        )
 
-    def _winner_biv_id(self):
-        res = E15Nominee.query.select_from(pam.BivAccess).filter(
-            pam.BivAccess.source_biv_id == self.biv_id,
+
+class E15ContestSnapshot(object):
+    """Read-only copy of the contest's nominee data used by contest_info
+    and the public lists. Built with one query; the rows are dicts in the
+    form returned by the list actions and must not be modified.
+
+    Fields:
+        finalists: rows for is_finalist nominees ordered by display_name
+        finalist_ids: E15Nominee.biv_id of finalists (same order)
+        public_nominee_ids: frozenset of public E15Nominee.biv_id
+        public_nominees: rows for is_public nominees
+        semi_finalist_count: number of is_semi_finalist nominees
+        version: value of _snapshot_versions when built
+        winner_biv_id: is_winner E15Nominee.biv_id or None
+    """
+
+    def __init__(self, contest, version):
+        self.created = time.monotonic()
+        self.version = version
+        nominees = E15Nominee.query.select_from(pam.BivAccess).filter(
+            pam.BivAccess.source_biv_id == contest.biv_id,
             pam.BivAccess.target_biv_id == E15Nominee.biv_id,
-            E15Nominee.is_winner == True,
-        ).first()
-        return res.biv_id if res else None
+        ).all()
+        rows = {}
+        for n, biv_uri in zip(
+            nominees,
+            biv.encode_uris([n.biv_id for n in nominees]),
+        ):
+            rows[n.biv_id] = {
+                'biv_id': biv_uri,
+                'display_name': n.display_name,
+                'youtube_code': n.youtube_code,
+                'nominee_summary': common.summary_text(n.nominee_desc or ''),
+                'is_finalist': n.is_finalist,
+                'is_semi_finalist': n.is_semi_finalist,
+                'is_winner': n.is_winner,
+            }
+        public = [n for n in nominees if n.is_public]
+        self.public_nominee_ids = frozenset(n.biv_id for n in public)
+        self.public_nominees = tuple(rows[n.biv_id] for n in public)
+        finalists = sorted(
+            (n for n in nominees if n.is_finalist),
+            key=lambda n: n.display_name,
+        )
+        self.finalist_ids = tuple(n.biv_id for n in finalists)
+        self.finalists = tuple(rows[n.biv_id] for n in finalists)
+        self.semi_finalist_count = sum(
+            1 for n in nominees if n.is_semi_finalist)
+        self.winner_biv_id = next(
+            (n.biv_id for n in nominees if n.is_winner), None)
+
+
+def _vote_score():
+    """Points for a Vote based on vote_status"""
+    return sqlalchemy.case(
+        [
+            (pcm.Vote.vote_status == '1x', 1),
+            (pcm.Vote.vote_status == '2x', 2),
+        ],
+        else_=0,
+    )
+
+
+def invalidate_snapshot(contest_biv_id):
+    """Discards the E15ContestSnapshot for contest_biv_id in this process.
+    Call after committing changes to the contest's nominee flags; other
+    processes rebuild theirs after _SNAPSHOT_TTL."""
+    k = int(contest_biv_id)
+    _snapshot_versions[k] = _snapshot_versions.get(k, 0) + 1
+
+
+def invalidate_snapshot_on_commit(contest_biv_id):
+    """Calls invalidate_snapshot when the session's transaction commits
+    (at request teardown), so a concurrent rebuild can't cache the old
+    values"""
+    ppc.db.session.info.setdefault(_SNAPSHOT_INVALIDATIONS, set()).add(
+        int(contest_biv_id))
+
+
+def _invalidate_snapshots_after_commit(session):
+    for k in session.info.pop(_SNAPSHOT_INVALIDATIONS, ()):
+        invalidate_snapshot(k)
+
+
+def _discard_snapshot_invalidations(session):
+    session.info.pop(_SNAPSHOT_INVALIDATIONS, None)
 
 
 class E15EventVoter(db.Model, common.ModelWithDates):
@@ -368,72 +666,271 @@ class E15VoteAtEvent(db.Model, common.ModelWithDates):
                 alias_name=self.invite_nonce,
             ),
         )
+        biv.invalidate_alias(self.invite_nonce, self.biv_id)
         return self, True
 
+    @classmethod
+    def create_many(cls, contest, emails_or_phones):
+        """Registers validated emails_or_phones for contest unless they are
+        already registered. Rows and their BivAliases are inserted with
+        multi-row INSERTs. Returns (created, existing) emails_or_phones."""
+        registered = set(
+            r[0] for r in ppc.db.session.query(cls.invite_email_or_phone).filter(
+                cls.contest_biv_id == contest.biv_id,
+            )
+        )
+        created = []
+        existing = []
+        for v in emails_or_phones:
+            if v in registered:
+                existing.append(v)
+            else:
+                registered.add(v)
+                created.append(v)
+        voters = []
+        aliases = []
+        for biv_id, v in zip(common.reserve_biv_ids(cls, len(created)), created):
+            nonce = _invite_nonce()
+            voters.append(dict(
+                biv_id=biv_id,
+                contest_biv_id=contest.biv_id,
+                invite_email_or_phone=v,
+                invite_nonce=nonce,
+                invites_sent=0,
+            ))
+            aliases.append(dict(biv_id=biv_id, alias_name=nonce))
+        for i in range(0, len(voters), _INSERT_BATCH):
+            ppc.db.session.execute(
+                cls.__table__.insert().values(voters[i:i + _INSERT_BATCH]))
+            ppc.db.session.execute(
+                pam.BivAlias.__table__.insert().values(aliases[i:i + _INSERT_BATCH]))
+        for a in aliases:
+            biv.invalidate_alias(a['alias_name'], a['biv_id'])
+        return created, existing
+
     def save_to_session(self):
         flask.session[self._NONCE_ATTR] = self.invite_nonce
 
+    def is_invite_due(self, force):
+        """True if an invite should be sent: none has been sent (unless
+        force) and MAX_INVITES_SENT has not been reached"""
+        return not (
+            self.invites_sent > 0 and not force
+            or self.invites_sent >= ppc.app().config['PUBLICPRIZE']['MAX_INVITES_SENT']
+        )
+
     def send_invite(self, force):
         """Email or SMS voting link"""
         uri = self.format_absolute_uri()
-        if (
-            self.invites_sent > 0 and not force
-            or self.invites_sent >= ppc.app().config['PUBLICPRIZE']['MAX_INVITES_SENT']
-        ):
+        if not self.is_invite_due(force):
             pp_t('NOT sending to={} uri={}', [self.invite_email_or_phone, uri])
             return None
-        pp_cfg = ppc.app().config['PUBLICPRIZE']
-        assert pp_cfg['TEST_MODE'] or not re.search('/localhost|/127', uri), \
-            'uri={}: uri contains local host'
-        pp_t('to={} uri={}', [self.invite_email_or_phone, uri])
-        msg_args = dict(
-            contest=self.contest.display_name,
-            uri=uri,
-        )
-        if pp_cfg['MAIL_SUPPRESS_SEND']:
-            pp_t('MAIL_SUPPRESS_SEND=True')
-        if is_email(self.invite_email_or_phone):
-            import flask_mail
-            msg = flask_mail.Message(
-                subject=_SEND_INVITE_MAIL_SUBJECT.format(**msg_args),
-                sender=(self.contest.display_name, pp_cfg['SUPPORT_EMAIL']),
-                recipients=[self.invite_email_or_phone],
-                body=_SEND_INVITE_MAIL_BODY.format(**msg_args),
-            )
-            ppc.mail().send(msg)
-        else:
-            import twilio.rest
-            cfg = pp_cfg['TWILIO']
-            c = twilio.rest.TwilioRestClient(**cfg['auth'])
-            sms_args = dict(
-                to=self.invite_email_or_phone,
-                from_=cfg['from'],
-                body=_SEND_INVITE_SMS_BODY.format(**msg_args),
-            )
-            if not pp_cfg['MAIL_SUPPRESS_SEND']:
-                c.sms.messages.create(**sms_args)
+        send_invite_message(
+            self.invite_email_or_phone, self.contest.display_name, uri)
         self.invites_sent += 1
         return uri
 
     @classmethod
     def validate_session(cls, contest):
+        """Returns (True, E15VoterEntry) if the session's invite is for
+        contest, else (False, None)"""
         i = flask.session.get(cls._NONCE_ATTR)
         if not i:
             pp_t('no invite_nonce')
             return False, None
-        self = cls.query.filter_by(invite_nonce=i).first()
-        if not self:
+        e = E15VoterIndex.get(contest.biv_id).by_nonce.get(i) \
+            or _voter_lookup(cls.invite_nonce == i)
+        if not e:
             pp_t('invite nonce not found, another db?')
             return False, None
-        if self.contest_biv_id != contest.biv_id:
+        if e.contest_biv_id != contest.biv_id:
             pp_t(
                 'nonce={} expect_contest={} actual_contest={}',
-                [i, contest.biv_id, self.contest_biv_id],
+                [i, contest.biv_id, e.contest_biv_id],
             )
             return False, None
-        return True, self
+        return True, e
+
+    @classmethod
+    def vote(cls, entry, nominee_biv_id, user_biv_id, user_agent, remote_addr):
+        """Records the vote for entry (E15VoterEntry) with one UPDATE
+        unless it has already voted in any process. Returns True if the
+        vote was recorded."""
+        n = cls.query.filter(
+            cls.biv_id == entry.biv_id,
+            cls.nominee_biv_id.is_(None),
+        ).update(
+            dict(
+                nominee_biv_id=nominee_biv_id,
+                remote_addr=remote_addr,
+                user_agent=user_agent,
+                user_biv_id=user_biv_id,
+            ),
+            synchronize_session=False,
+        )
+        if n:
+            # Other requests only see the vote once it is committed
+            ppc.db.session.info.setdefault(_EVENT_VOTES, []).append(
+                entry._replace(nominee_biv_id=nominee_biv_id))
+        else:
+            pp_t('{}: already voted', [entry.biv_id])
+            _voter_lookup(cls.biv_id == entry.biv_id)
+        return bool(n)
+
+
+def _add_event_votes_after_commit(session):
+    # No SQL can be emitted after commit, so caches which aren't built
+    # aren't built here; they will read the votes from the database
+    for e in session.info.pop(_EVENT_VOTES, ()):
+        k = int(e.contest_biv_id)
+        index = _voter_indexes.get(k)
+        if index:
+            index.add(e)
+        t = _event_tallies.get(k)
+        if t:
+            t.add(e.nominee_biv_id)
+
+
+def _discard_event_votes(session):
+    session.info.pop(_EVENT_VOTES, None)
+
+
+class E15EventTally(object):
+    """This process's event vote counters for a contest. Built with one
+    GROUP BY query. Votes in this process are added as they are cast, and
+    others are seen when it is rebuilt.
+
+    Fields:
+        counts: votes by E15Nominee.biv_id (int)
+        created: time.monotonic() when built
+        lock: held while counts is read or modified
+        total: registered voters
+    """
+
+    def __init__(self, contest_biv_id):
+        self.counts = {}
+        self.created = time.monotonic()
+        self.lock = threading.Lock()
+        self.total = 0
+        for nominee_biv_id, n in db.session.query(
+            E15VoteAtEvent.nominee_biv_id,
+            sqlalchemy.func.count(E15VoteAtEvent.biv_id),
+        ).filter(
+            E15VoteAtEvent.contest_biv_id == contest_biv_id,
+        ).group_by(
+            E15VoteAtEvent.nominee_biv_id,
+        ):
+            self.total += n
+            if nominee_biv_id is not None:
+                self.counts[int(nominee_biv_id)] = n
+
+    def add(self, nominee_biv_id):
+        """Counts a vote cast in this process"""
+        k = int(nominee_biv_id)
+        with self.lock:
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    @classmethod
+    def get(cls, contest_biv_id):
+        """Returns the contest's tally, rebuilding it if it is missing or
+        older than _EVENT_TALLY_TTL seconds"""
+        k = int(contest_biv_id)
+        res = _event_tallies.get(k)
+        if res is None or res.created + _EVENT_TALLY_TTL < time.monotonic():
+            res = cls(k)
+            _event_tallies[k] = res
+        return res
+
+
+# An E15VoteAtEvent in an E15VoterIndex
+E15VoterEntry = collections.namedtuple(
+    'E15VoterEntry',
+    'biv_id contest_biv_id invite_nonce nominee_biv_id',
+)
+
+
+class E15VoterIndex(object):
+    """The contest's E15VoteAtEvent invites, so validate_session doesn't
+    query. Built with one query when the first invitee votes, which also
+    caches the nonces' BivAliases for the invite landing. Votes in this
+    process update the index; others are seen when it is rebuilt.
+
+    Fields:
+        by_biv_id: E15VoterEntry by biv_id
+        by_nonce: E15VoterEntry by invite_nonce
+        created: time.monotonic() when built
+    """
+
+    def __init__(self, contest_biv_id):
+        self.created = time.monotonic()
+        self.by_biv_id = {}
+        self.by_nonce = {}
+        for r in _voter_query().filter(
+            E15VoteAtEvent.contest_biv_id == contest_biv_id,
+        ):
+            e = _voter_entry(r)
+            self.add(e)
+            biv.cache_alias(e.invite_nonce, e.biv_id)
+
+    def add(self, entry):
+        """Adds or replaces entry"""
+        self.by_biv_id[entry.biv_id] = entry
+        self.by_nonce[entry.invite_nonce] = entry
+
+    @classmethod
+    def get(cls, contest_biv_id):
+        """Returns the contest's index, building it if it is missing or
+        older than _VOTER_INDEX_TTL seconds. Expired indexes of other
+        contests are dropped."""
+        k = int(contest_biv_id)
+        res = _voter_indexes.get(k)
+        if res is None or res.is_expired():
+            with _voter_index_lock:
+                res = _voter_indexes.get(k)
+                if res is None or res.is_expired():
+                    for i, index in list(_voter_indexes.items()):
+                        if index.is_expired():
+                            del _voter_indexes[i]
+                    res = cls(k)
+                    _voter_indexes[k] = res
+        return res
+
+    def is_expired(self):
+        return self.created + _VOTER_INDEX_TTL < time.monotonic()
+
+
+def _voter_entry(row):
+    return E15VoterEntry(int(row[0]), int(row[1]), row[2], row[3])
+
+
+def _voter_lookup(criterion):
+    """Reads the E15VoterEntry matching criterion and adds it to its
+    contest's index. Returns None if not found."""
+    r = _voter_query().filter(criterion).first()
+    if not r:
+        return None
+    res = _voter_entry(r)
+    E15VoterIndex.get(res.contest_biv_id).add(res)
+    return res
+
+
+def _voter_query():
+    return db.session.query(
+        E15VoteAtEvent.biv_id,
+        E15VoteAtEvent.contest_biv_id,
+        E15VoteAtEvent.invite_nonce,
+        E15VoteAtEvent.nominee_biv_id,
+    )
 
 
 E15Contest.BIV_MARKER = biv.register_marker(15, E15Contest)
 E15Nominee.BIV_MARKER = biv.register_marker(16, E15Nominee)
 E15VoteAtEvent.BIV_MARKER = biv.register_marker(19, E15VoteAtEvent)
+sqlalchemy.event.listen(
+    sqlalchemy.orm.Session, 'after_commit', _invalidate_snapshots_after_commit)
+sqlalchemy.event.listen(
+    sqlalchemy.orm.Session, 'after_rollback', _discard_snapshot_invalidations)
+sqlalchemy.event.listen(
+    sqlalchemy.orm.Session, 'after_commit', _add_event_votes_after_commit)
+sqlalchemy.event.listen(
+    sqlalchemy.orm.Session, 'after_rollback', _discard_event_votes)
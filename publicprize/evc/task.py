@@ -17,6 +17,7 @@ import werkzeug.exceptions
 
 from ..debug import pp_t
 from . import form as pef
+from . import invite_dispatch as peid
 from . import model as pem
 from .. import biv
 from .. import common
@@ -24,6 +25,7 @@ from .. import controller as ppc
 from ..auth import model as pam
 from ..general import oauth
 from ..contest import model as pcm
+from ..contest import vote_queue as pcvq
 
 _template = common.Template('evc')
 
@@ -31,28 +33,36 @@ _template = common.Template('evc')
 class E15Contest(ppc.Task):
     """Contest actions"""
 
+    @common.decorator_login_required
+    @common.decorator_user_is_registrar
+    def action_admin_event_vote_counts(biv_obj):
+        return flask.jsonify(biv_obj.event_vote_counts())
+
     @common.decorator_login_required
     @common.decorator_user_is_registrar
     def action_admin_event_votes(biv_obj):
-        return flask.jsonify(biv_obj.admin_event_votes())
+        """Event vote counts and a page of registered voters. Pass the
+        page's after for the next page."""
+        args = flask.request.args
+        return flask.jsonify(biv_obj.admin_event_votes(
+            after=args.get('after'),
+            limit=args.get('limit', type=int),
+        ))
+
+    @common.decorator_login_required
+    @common.decorator_user_is_admin
+    def action_admin_invite_progress(biv_obj):
+        return flask.jsonify(peid.progress(biv_obj.biv_id))
 
     @common.decorator_login_required
     @common.decorator_user_is_admin
     def action_admin_review_judges(biv_obj):
-        users = pcm.Judge.judge_users_for_contest(biv_obj)
-        nominee_ids = {}
-        for nominee in biv_obj.public_nominees():
-            nominee_ids[nominee.biv_id] = True
         res = []
-
-        for user in users:
-            count = 0
-            for rank in pcm.JudgeRank.judge_ranks_for_user(user.biv_id):
-                if rank.nominee_biv_id in nominee_ids:
-                    count += 1
+        for _, display_name, user_email, count in pcm.Judge.judging_progress(
+                biv_obj, biv_obj.snapshot().public_nominee_ids):
             res.append({
-                'display_name': user.display_name,
-                'user_email': user.user_email,
+                'display_name': display_name,
+                'user_email': user_email,
                 'rank_count': count,
             })
         return flask.jsonify({
@@ -93,7 +103,7 @@ class E15Contest(ppc.Task):
     @common.decorator_login_required
     @common.decorator_user_is_registrar
     def action_admin_review_scores(biv_obj):
-        scores = biv_obj.tally_all_scores();
+        scores = biv_obj.tally_all_scores(cached=True)
         return flask.jsonify({
             'scores': sorted(scores, key=lambda nominee: nominee['display_name'])
         })
@@ -101,41 +111,42 @@ class E15Contest(ppc.Task):
     @common.decorator_login_required
     @common.decorator_user_is_admin
     def action_admin_review_votes(biv_obj):
-        res = []
-        nominee_id_to_name = {}
-        for nominee in biv_obj.public_nominees():
-            nominee_id_to_name[nominee.biv_id] = nominee.display_name
-
-        for vote in pcm.Vote.query.select_from(pam.User).filter(
-                pcm.Vote.nominee_biv_id.in_(nominee_id_to_name.keys()),
-        ).all():
-            user = pam.User.query.filter_by(
-                biv_id=vote.user
-            ).one()
-            res.append({
-                'biv_id': vote.biv_id,
-                'creation_date_time': vote.creation_date_time,
-                'user_display_name': '{} ({})'.format(user.display_name, user.user_email),
-                'twitter_handle': vote.twitter_handle,
-                'nominee_display_name': nominee_id_to_name[vote.nominee_biv_id],
-                'vote_status': vote.vote_status,
+        """Streams all votes, newest first, or a page of them if limit is
+        supplied. Pass the last biv_id of a page as before for the next."""
+        args = flask.request.args
+        if 'limit' in args:
+            votes = list(biv_obj.admin_review_votes(
+                before=args.get('before', type=int),
+                limit=args.get('limit', type=int),
+            ))
+            return flask.jsonify({
+                'votes': votes,
+                'before': votes[-1]['biv_id'] if votes else None,
             })
-        res = sorted(res, key=lambda vote: vote['creation_date_time'])
-        res.reverse()
-        return flask.jsonify({
-            'votes':  res
-        })
+
+        def stream():
+            yield '{"votes": ['
+            sep = ''
+            for v in biv_obj.admin_review_votes():
+                yield sep + flask.json.dumps(v)
+                sep = ','
+            yield ']}'
+
+        return flask.Response(
+            flask.stream_with_context(stream()),
+            mimetype='application/json',
+        )
 
     @common.decorator_login_required
     @common.decorator_user_is_admin
     def action_admin_send_invites(biv_obj):
-        query = dict(contest_biv_id=biv_obj.biv_id)
-        sent = 0
         force = 'force' in (flask.request.pp_request['path_info'] or '')
-        for vae in pem.E15VoteAtEvent.query.filter_by(**query).all():
-            sent += int(bool(vae.send_invite(force=force)))
-            ppc.db.session.add(vae)
-        return flask.jsonify({'sent': sent})
+        return flask.jsonify(peid.start(biv_obj, force))
+
+    @common.decorator_login_required
+    @common.decorator_user_is_admin
+    def action_admin_vote_queue(biv_obj):
+        return flask.jsonify(pcvq.stats())
 
     @common.decorator_login_required
     @common.decorator_user_is_admin
@@ -150,6 +161,7 @@ class E15Contest(ppc.Task):
             '{}: invalid nominee cannot make public'.format(nominee)
         nominee.is_public = is_public
         ppc.db.session.add(nominee)
+        pem.invalidate_snapshot_on_commit(biv_obj.biv_id)
         return '{}'
 
     @common.decorator_login_required
@@ -172,17 +184,21 @@ class E15Contest(ppc.Task):
             resp = 'Live voting is over' if biv_obj.is_expired() else 'Live voting has not yet started'
         else:
             data = flask.request.get_json()
-            nominee = E15Contest._lookup_nominee_by_biv_uri(biv_obj, data)
+            nominee_biv_id = biv.URI(data['nominee_biv_id']).biv_id
+            # the snapshot is cached, so this doesn't query
+            if nominee_biv_id not in biv_obj.snapshot().public_nominee_ids:
+                werkzeug.exceptions.abort(404)
             is_event_voter, vae = pem.E15VoteAtEvent.validate_session(biv_obj)
             if not is_event_voter:
                 resp = 'You are not allowed to vote'
-            elif vae.nominee_biv_id:
-                resp = None
-            else:
-                vae.nominee_biv_id = nominee.biv_id
-                vae.user_biv_id = flask.session.get('user.biv_id', None)
-                vae.user_agent = flask.request.headers.get('User-Agent')[:100]
-                vae.remote_addr = flask.request.remote_addr
+            elif not vae.nominee_biv_id:
+                pem.E15VoteAtEvent.vote(
+                    vae,
+                    nominee_biv_id,
+                    flask.session.get('user.biv_id', None),
+                    flask.request.headers.get('User-Agent')[:100],
+                    flask.request.remote_addr,
+                )
         return flask.jsonify({'message': resp} if resp else {})
 
     def action_index(biv_obj):
@@ -316,25 +332,27 @@ class E15Contest(ppc.Task):
     @common.decorator_login_required
     def action_nominee_vote(biv_obj):
         data = flask.request.json
-        nominee = E15Contest._lookup_nominee_by_biv_uri(biv_obj, data)
-        if biv_obj.is_expired() or E15Contest._user_vote(biv_obj):
+        nominee_ids = biv_obj.snapshot().public_nominee_ids
+        nominee_biv_id = biv.URI(data['nominee_biv_id']).biv_id
+        if nominee_biv_id not in nominee_ids:
+            werkzeug.exceptions.abort(404)
+        if biv_obj.is_expired():
             return '{}'
-        vote = pcm.Vote(
-            user=flask.session.get('user.biv_id'),
-            nominee_biv_id=nominee.biv_id,
-            vote_status='1x',
+        pcvq.submit(
+            biv_obj.biv_id,
+            flask.session.get('user.biv_id'),
+            nominee_biv_id,
+            {
+                'user_id': flask.session.get('user.biv_id'),
+                'nominee': nominee_biv_id,
+                'user-agent': flask.request.headers.get('User-Agent'),
+                'route': flask.request.access_route[0][:100],
+            },
         )
-        ppc.db.session.add(vote)
-        ppc.app().logger.warn('user vote: {}'.format({
-            'user_id': flask.session.get('user.biv_id'),
-            'nominee': nominee.biv_id,
-            'user-agent': flask.request.headers.get('User-Agent'),
-            'route': flask.request.access_route[0][:100],
-        }))
         return '{}'
 
     def action_finalist_list(biv_obj):
-        finalists = biv_obj.get_finalists()
+        finalists = list(biv_obj.snapshot().finalists)
         if flask.session.get('user.is_logged_in'):
             random.Random(flask.session.get('user.biv_id')).shuffle(finalists)
         elif flask.request.data:
@@ -342,41 +360,19 @@ class E15Contest(ppc.Task):
             random.Random(data['random_value']).shuffle(finalists)
         else:
             random.shuffle(finalists)
-        res = []
-        for nominee in finalists:
-            res.append({
-                'biv_id': biv.Id(nominee.biv_id).to_biv_uri(),
-                'display_name': nominee.display_name,
-                'youtube_code': nominee.youtube_code,
-                'nominee_summary': common.summary_text(nominee.nominee_desc),
-                'is_finalist': nominee.is_finalist,
-                'is_semi_finalist': nominee.is_semi_finalist,
-                'is_winner': nominee.is_winner,
-            })
         return flask.jsonify({
-            'finalists': res,
+            'finalists': finalists,
         })
 
     def action_public_nominee_list(biv_obj):
-        nominees = biv_obj.public_nominees()
+        nominees = list(biv_obj.snapshot().public_nominees)
         if flask.request.data:
             data = flask.request.json
             random.Random(data['random_value']).shuffle(nominees)
         else:
             random.shuffle(nominees)
-        res = []
-        for nominee in nominees:
-            res.append({
-                'biv_id': biv.Id(nominee.biv_id).to_biv_uri(),
-                'display_name': nominee.display_name,
-                'youtube_code': nominee.youtube_code,
-                'nominee_summary': common.summary_text(nominee.nominee_desc),
-                'is_finalist': nominee.is_finalist,
-                'is_semi_finalist': nominee.is_semi_finalist,
-                'is_winner': nominee.is_winner,
-            })
         return flask.jsonify({
-            'nominees': res,
+            'nominees': nominees,
         })
 
     @common.decorator_user_is_registrar
@@ -400,7 +396,8 @@ class E15Contest(ppc.Task):
         return flask.redirect('/static/pdf/20170830-evc-rules.pdf')
 
     def action_sponsors(biv_obj):
-        return flask.jsonify(sponsors=biv_obj.get_sponsors())
+        return flask.jsonify(
+            sponsors=common.serialize_many(biv_obj.get_sponsors()))
 
     def action_user_state(biv_obj):
         # Relies on session user (ie this person) to calculate these values so is secure
@@ -466,19 +463,10 @@ class E15Contest(ppc.Task):
         """ Returns the user's vote or None """
         if not flask.session.get('user.is_logged_in'):
             return False
-        nominee_ids = {}
-        for nominee in contest.public_nominees():
-            nominee_ids[nominee.biv_id] = True
-        user_vote = None
-
-        for vote in pcm.Vote.query.filter_by(
-                user=flask.session.get('user.biv_id'),
-        ).all():
-            if vote.nominee_biv_id in nominee_ids:
-                if user_vote:
-                    raise Exception('user has multiple votes: {}'.format(flask.session.get('user.biv_id')))
-                user_vote = vote
-        return user_vote
+        return pcm.Vote.query.filter_by(
+            contest_biv_id=contest.biv_id,
+            user=flask.session.get('user.biv_id'),
+        ).first()
 
 
 class E15Nominee(ppc.Task):
@@ -501,15 +489,14 @@ class E15Nominee(ppc.Task):
 class E15VoteAtEvent(ppc.Task):
     def action_index(biv_obj):
         """Returns angular app home and sets session"""
-        pp_t('obj={} contest={}', [biv_obj, biv_obj.contest_biv_id])
-        c = biv.load_obj(biv_obj.contest_biv_id)
         biv_obj.save_to_session()
-        pp_t('contest={}', [c])
-        flask.session['vote_at_event.invite_nonce'] = biv_obj.invite_nonce
-        pp_t('{}', c.format_uri(anchor='/event-voting'));
+        # contest_biv_id avoids loading the contest
+        uri = '/{}#/event-voting'.format(
+            biv.Id(biv_obj.contest_biv_id).to_biv_uri())
+        pp_t('obj={} redirect_uri={}', [biv_obj, uri])
         return _template.render_template(
             biv_obj,
             'javascript-redirect',
-            redirect_uri=c.format_uri(anchor='/event-voting'),
+            redirect_uri=uri,
             base_template=None,
         )
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+""" Pooled SMTP connections for flask_mail.
+
+flask_mail's Mail.send() connects, authenticates, and quits for every
+message. A Pool keeps up to size authenticated connections (mail.connect()
+sessions) open between sends. A connection the server has closed is
+replaced and the message is sent again on the new connection. Connections
+idle longer than max_idle are closed rather than used, since servers drop
+idle clients.
+
+Sink is a minimal SMTP server which keeps the messages it receives. Tests
+send to it, and manage.py mail_sink runs one for development (set
+MAIL_SERVER and MAIL_PORT to it).
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import os
+import smtplib
+import socket
+import socketserver
+import threading
+import time
+
+
+class Pool(object):
+    """Open SMTP connections for mail
+
+    Args:
+        mail (flask_mail.Mail): configures the connections
+        size (int): idle connections kept open
+        max_idle (float): seconds before an idle connection is closed
+    """
+
+    def __init__(self, mail, size=8, max_idle=60):
+        self.mail = mail
+        self.max_idle = max_idle
+        self.size = size
+        self.stats = dict(opened=0, reconnects=0, sent=0)
+        # (time last used, connection)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def send(self, message):
+        """Sends message on a pooled connection"""
+        self.send_many([message])
+
+    def send_many(self, messages):
+        """Sends messages in one session, reconnecting if the server closes
+        the connection. Must be called in an app context."""
+        c = self._checkout()
+        try:
+            for m in messages:
+                try:
+                    c.send(m)
+                except _DISCONNECTED:
+                    with self._lock:
+                        self.stats['reconnects'] += 1
+                    self._close(c)
+                    c = self._open()
+                    c.send(m)
+                with self._lock:
+                    self.stats['sent'] += 1
+        except BaseException:
+            self._close(c)
+            raise
+        self._checkin(c)
+
+    def _checkin(self, c):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((time.monotonic(), c))
+                return
+        self._close(c)
+
+    def _checkout(self):
+        stale = []
+        res = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # Sockets are not shared with forked processes
+                self._idle = []
+                self._pid = os.getpid()
+            expires = time.monotonic() - self.max_idle
+            while self._idle:
+                t, c = self._idle.pop()
+                if t > expires:
+                    res = c
+                    break
+                stale.append(c)
+        for c in stale:
+            self._close(c)
+        return res or self._open()
+
+    def _close(self, c):
+        try:
+            c.__exit__(None, None, None)
+        except Exception:
+            # Already disconnected
+            pass
+
+    def _open(self):
+        c = self.mail.connect()
+        c.__enter__()
+        with self._lock:
+            self.stats['opened'] += 1
+        return c
+
+
+class Sink(object):
+    """SMTP server on localhost which keeps the messages it receives in
+    messages: dicts with sender, recipients, and data (bytes). AUTH is
+    accepted without checking.
+
+    Args:
+        port (int): 0 picks a free port
+        stream (file): messages are also written to it
+    """
+
+    def __init__(self, port=0, stream=None):
+        self.connections = 0
+        self.messages = []
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', int(port)),
+            _SinkHandler,
+        )
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self.port = self._server.server_address[1]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add(self, message):
+        with self._lock:
+            self.messages.append(message)
+            if self.stream:
+                self.stream.write('From: {sender}\nTo: {recipients}\n\n'.format(**message))
+                self.stream.write(message['data'].decode('utf-8', 'replace'))
+                self.stream.write('\n')
+                self.stream.flush()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves in a thread"""
+        t = threading.Thread(target=self.serve_forever, name='mail_sink')
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """One SMTP session"""
+
+    def handle(self):
+        sink = self.server.sink
+        with sink._lock:
+            sink.connections += 1
+        self._reply('220 sink')
+        sender = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd, _, arg = line.decode('ascii', 'replace').rstrip('\r\n').partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'EHLO':
+                self._reply('250-sink', '250 AUTH PLAIN')
+            elif cmd == 'AUTH':
+                self._reply('235 accepted')
+            elif cmd == 'MAIL':
+                sender = _address(arg)
+                recipients = []
+                self._reply('250 ok')
+            elif cmd == 'RCPT':
+                recipients.append(_address(arg))
+                self._reply('250 ok')
+            elif cmd == 'DATA':
+                self._reply('354 end with .')
+                sink.add(dict(
+                    sender=sender,
+                    recipients=recipients,
+                    data=self._data(),
+                ))
+                self._reply('250 ok')
+            elif cmd == 'QUIT':
+                self._reply('221 bye')
+                return
+            elif cmd in ('HELO', 'NOOP', 'RSET'):
+                self._reply('250 ok')
+            else:
+                self._reply('502 not implemented')
+
+    def _data(self):
+        res = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b'.\r\n':
+                return b''.join(res)
+            # Undo dot stuffing
+            res.append(line[1:] if line.startswith(b'..') else line)
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(l + '\r\n' for l in lines).encode('ascii'))
+
+
+def _address(arg):
+    """Address in MAIL FROM:<a> or RCPT TO:<a>"""
+    return arg.partition(':')[2].split(' ')[0].strip('<>')
+
+
+# Raised by smtplib when the server has closed the connection
+_DISCONNECTED = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
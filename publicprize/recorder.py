@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+""" Records requests and their responses for debugging and replay.
+
+Each sampled request is one record appended to a log file: a 4 byte
+big-endian length followed by the JSON record. Bodies are base64 encoded
+and truncated at max_body; request_truncated or response_truncated is set
+if they were.
+A writer thread appends records so requests don't wait on the disk, and
+the file is rotated when it reaches max_bytes.
+
+Credentials are not recorded: Cookie, Authorization, and Set-Cookie
+headers and password-like fields in form and JSON bodies are replaced
+with a marker. Requests in the same session have the same session_key, an
+HMAC of the session cookie with SECRET_KEY, so they can be replayed in
+sequence (see replay.py) without recording the cookie.
+
+Enable in production with PUBLICPRIZE.RECORD_FILE and RECORD_SAMPLE
+(fraction of requests recorded). Each uwsgi worker writes and rotates its
+own file, RECORD_FILE.<pid>. Records are read with read().
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import queue
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+import werkzeug.http
+
+
+def init(app):
+    """Records app's requests if PUBLICPRIZE.RECORD_FILE is set"""
+    from . import session
+
+    cfg = app.config['PUBLICPRIZE']
+    if not cfg.get('RECORD_FILE'):
+        return
+    sample = cfg.get('RECORD_SAMPLE')
+    app.wsgi_app = Recorder(
+        app.wsgi_app,
+        cfg['RECORD_FILE'],
+        sample=1.0 if sample is None else float(sample),
+        per_process=True,
+        session_cookie=session.COOKIE_NAME,
+        secret_key=app.config.get('SECRET_KEY'),
+    )
+
+
+def body(record, key):
+    """Decoded request_body or response_body of record"""
+    return base64.b64decode(record[key]) if record.get(key) else b''
+
+
+def read(path):
+    """Yields the records in path"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            data = f.read(_HEADER.unpack(header)[0])
+            yield json.loads(data.decode('utf-8'))
+
+
+class Recorder(object):
+    """WSGI middleware which records a sample of requests to path
+
+    Args:
+        wsgi_app (callable): application being recorded
+        path (str): log file
+        sample (float): fraction of requests recorded
+        max_body (int): bodies larger than this are truncated
+        max_bytes (int): log file is rotated when it is this large
+        backup_count (int): rotated files kept (path.1, path.2, ...)
+        is_sync (bool): write in the request's thread (for tests)
+        per_process (bool): each process writes path.<pid>
+        session_cookie (str): cookie hashed into session_key
+        secret_key (str): HMAC key for session_key
+    """
+
+    def __init__(self, wsgi_app, path, sample=1.0, max_body=64 * 1024,
+                 max_bytes=100 * 1024 * 1024, backup_count=5, is_sync=False,
+                 per_process=False, session_cookie=None, secret_key=None):
+        self.backup_count = backup_count
+        self.dropped = 0
+        self.is_sync = is_sync
+        self.max_body = max_body
+        self.max_bytes = max_bytes
+        self.path = path
+        self.per_process = per_process
+        self.sample = sample
+        self.secret_key = secret_key
+        self.session_cookie = session_cookie
+        self._file = None
+        self._file_path = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if self.sample < 1 and random.random() >= self.sample:
+            return self._wsgi_app(environ, start_response)
+        record = _request_record(environ, self.max_body)
+        key = self._session_key(environ)
+        if key:
+            record['session_key'] = key
+
+        def _start_response(status, response_headers, exc_info=None):
+            record['status'] = status
+            record['response_headers'] = [
+                (k, _REDACTED if k.lower() == 'set-cookie' else v)
+                for k, v in response_headers
+            ]
+            return start_response(status, response_headers, exc_info)
+
+        return _Response(
+            self,
+            record,
+            self._wsgi_app(environ, _start_response),
+        )
+
+    def set_path(self, path):
+        """Write subsequent records to path"""
+        with self._lock:
+            self._close()
+            self.path = path
+
+    def write(self, record):
+        """Queue record to be appended to the log. Records are dropped if
+        the writer falls behind."""
+        data = json.dumps(record, default=str).encode('utf-8')
+        data = _HEADER.pack(len(data)) + data
+        if self.is_sync:
+            self._append(data)
+            return
+        try:
+            self._writer_queue().put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def _append(self, data):
+        with self._lock:
+            try:
+                path = self.path
+                if self.per_process:
+                    path = '{}.{}'.format(path, os.getpid())
+                if self._file_path != path:
+                    # A forked process doesn't append to its parent's file
+                    self._close()
+                if not self._file:
+                    self._file = open(path, 'ab')
+                    self._file_path = path
+                self._file.write(data)
+                self._file.flush()
+                if self._file.tell() >= self.max_bytes:
+                    self._rotate()
+            except Exception as e:
+                sys.stderr.write('{}: record failed: {}\n'.format(path, e))
+                self._close()
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._file_path = None
+
+    def _rotate(self):
+        # Only this process writes the file, so it can be renamed safely
+        path = self._file_path
+        self._close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(path, i + 1))
+        if self.backup_count:
+            os.replace(path, path + '.1')
+        else:
+            os.remove(path)
+
+    def _run(self, q):
+        while True:
+            self._append(q.get())
+
+    def _session_key(self, environ):
+        """HMAC of the session cookie, which identifies the session
+        without revealing the cookie"""
+        if not (self.session_cookie and self.secret_key):
+            return None
+        value = werkzeug.http.parse_cookie(environ).get(self.session_cookie)
+        if not value:
+            return None
+        return hmac.new(
+            self.secret_key.encode('utf-8'),
+            value.encode('utf-8'),
+            hashlib.sha256,
+        ).hexdigest()
+
+    def _writer_queue(self):
+        # uwsgi forks workers after the app is loaded, so each process
+        # needs its own writer thread
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(_MAX_QUEUED)
+                    t = threading.Thread(target=self._run, args=(self._queue,))
+                    t.daemon = True
+                    t.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+
+class _PrefixedInput(io.RawIOBase):
+    """Input which returns prefix followed by the rest of stream"""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._prefix:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _Response(object):
+    """Collects the response body and writes the record on close"""
+
+    def __init__(self, recorder, record, response):
+        self._body = io.BytesIO()
+        self._is_truncated = False
+        self._record = record
+        self._recorder = recorder
+        self._response = response
+
+    def close(self):
+        try:
+            if hasattr(self._response, 'close'):
+                self._response.close()
+        finally:
+            r = self._record
+            r['duration'] = time.time() - r['time']
+            r['response_body'] = _encode(self._body.getvalue())
+            if self._is_truncated:
+                r['response_truncated'] = True
+            self._recorder.write(r)
+
+    def __iter__(self):
+        for data in self._response:
+            if data and self._body.tell() < self._recorder.max_body:
+                n = self._recorder.max_body - self._body.tell()
+                self._body.write(data[:n])
+                self._is_truncated = self._is_truncated or len(data) > n
+            elif data:
+                self._is_truncated = True
+            yield data
+
+
+def _encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _redact_body(content_type, data):
+    """data with the values of password-like fields replaced"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    try:
+        if content_type == 'application/x-www-form-urlencoded':
+            fields = urllib.parse.parse_qsl(
+                data.decode('utf-8'), keep_blank_values=True)
+            if not any(_SECRET_FIELD.search(k) for k, v in fields):
+                return data
+            return urllib.parse.urlencode([
+                (k, _REDACTED if _SECRET_FIELD.search(k) else v)
+                for k, v in fields
+            ]).encode('utf-8')
+        if content_type == 'application/json':
+            value = json.loads(data.decode('utf-8'))
+            redacted = _redact_json(value)
+            if redacted == value:
+                return data
+            return json.dumps(redacted).encode('utf-8')
+    except ValueError:
+        # Not parseable, so nothing to find the fields in
+        return _REDACTED.encode('ascii')
+    return data
+
+
+def _redact_json(value):
+    if isinstance(value, dict):
+        return dict(
+            (k, _REDACTED if _SECRET_FIELD.search(k) else _redact_json(v))
+            for k, v in value.items()
+        )
+    if isinstance(value, list):
+        return [_redact_json(v) for v in value]
+    return value
+
+
+def _request_record(environ, max_body):
+    """Request fields needed to replay it, less credentials. The body is
+    read and replaced in environ."""
+    res = {
+        'time': time.time(),
+        'method': environ.get('REQUEST_METHOD'),
+        'path': environ.get('PATH_INFO'),
+        'query': environ.get('QUERY_STRING', ''),
+        'headers': dict(
+            (k, _REDACTED if k in _SECRET_HEADERS else v)
+            for k, v in environ.items()
+            if k.startswith('HTTP_') or k in ('CONTENT_TYPE', 'CONTENT_LENGTH')
+        ),
+        'remote_addr': environ.get('REMOTE_ADDR'),
+    }
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > 0 and 'wsgi.input' in environ:
+        data = environ['wsgi.input'].read(min(length, max_body))
+        if length > max_body:
+            # The app reads the rest of the body from the original input
+            environ['wsgi.input'] = io.BufferedReader(
+                _PrefixedInput(data, environ['wsgi.input']))
+            res['request_truncated'] = True
+        else:
+            environ['wsgi.input'] = io.BytesIO(data)
+        res['request_body'] = _encode(
+            _redact_body(environ.get('CONTENT_TYPE'), data))
+    return res
+
+
+_HEADER = struct.Struct('>I')
+# Records waiting for the writer thread
+_MAX_QUEUED = 1000
+# Replaces credentials in records
+_REDACTED = '<redacted>'
+_SECRET_FIELD = re.compile(r'passw|secret|token', re.IGNORECASE)
+_SECRET_HEADERS = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE', 'HTTP_PROXY_AUTHORIZATION')
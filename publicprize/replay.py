@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+""" Replays request sequences through the app to measure it under load.
+
+Sequences are lists of requests in the recorder format (see recorder.py).
+Each sequence runs in order with its own client (and so its own session
+cookie). Sequences run concurrently in worker threads against the
+configured database. Use a local copy of the database: requests change it.
+
+Recorded requests are grouped by session_key. The recorder doesn't keep
+the session cookie, so a replayed session starts anonymous. With login,
+each session's sequence starts with /pub/new-test-user (TEST_USER must be
+configured), and its requests run as that new logged-in user.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import collections
+import json
+import math
+import queue
+import threading
+import time
+
+from . import biv
+from . import controller as ppc
+from . import db_stats
+from . import recorder
+
+
+def event_voting_sequences(contest, polls=5):
+    """Synthesizes the event voting spike: every E15VoteAtEvent invitee
+    opens the invite, polls user-state and finalist-list, and votes. The
+    contest must be in event voting, see manage.py set_contest_date_time."""
+    import publicprize.evc.model as pem
+    contest_uri = '/' + biv.Id(contest.biv_id).to_biv_uri()
+    finalists = [n['biv_id'] for n in contest.snapshot().finalists]
+    assert finalists, '{}: no finalists'.format(contest)
+    vaes = pem.E15VoteAtEvent.query.filter_by(contest_biv_id=contest.biv_id).all()
+    assert vaes, '{}: no E15VoteAtEvent, see register_event_voters'.format(contest)
+    res = []
+    for i, vae in enumerate(vaes):
+        s = [_request('GET', '/' + biv.Id(vae.biv_id).to_biv_uri())]
+        for _ in range(polls):
+            s.append(_request('POST', contest_uri + '/user-state'))
+            s.append(_request('POST', contest_uri + '/finalist-list'))
+        s.append(_request(
+            'POST',
+            contest_uri + '/event-vote',
+            {'nominee_biv_id': finalists[i % len(finalists)]},
+        ))
+        s.append(_request('POST', contest_uri + '/user-state'))
+        res.append(s)
+    return res
+
+
+def recorded_sequences(path, login=False):
+    """Reads recorded requests grouped into sequences by session_key.
+    Requests without a session are each their own sequence. Requests with
+    truncated bodies can't be replayed, so they are skipped. If login, each
+    session's sequence starts by logging in as a new test user."""
+    by_session = collections.OrderedDict()
+    res = []
+    for r in recorder.read(path):
+        if 'method' not in r or r.get('request_truncated'):
+            continue
+        key = r.get('session_key')
+        if key:
+            by_session.setdefault(key, []).append(r)
+        else:
+            res.append([r])
+    if login:
+        for s in by_session.values():
+            s.insert(0, _request('GET', '/pub/new-test-user'))
+    return list(by_session.values()) + res
+
+
+def report(results):
+    """Formats run() results as a table"""
+    lines = ['{:<30} {:>6} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+        'action', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'req/s')]
+    for action, r in sorted(results['actions'].items()):
+        lines.append('{:<30} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7.1f}'.format(
+            action[:30], r['count'], r['p50'] * 1000, r['p95'] * 1000,
+            r['p99'] * 1000, r['queries'], r['throughput']))
+    for action, r in sorted(results['actions'].items()):
+        for q in r['n_plus_one']:
+            lines.append('N+1 {}: {}'.format(action, q))
+    lines.append('{} requests, {} errors, {:.1f}s, {:.1f} req/s'.format(
+        results['count'], results['errors'], results['elapsed'],
+        results['throughput']))
+    return '\n'.join(lines)
+
+
+def run(sequences, concurrency=10):
+    """Runs sequences with concurrency threads. Returns stats per action:
+    count, latency percentiles (seconds), mean queries, suspected N+1
+    statements (see db_stats) and throughput."""
+    work = queue.Queue()
+    for s in sequences:
+        work.put(s)
+    samples = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                sequence = work.get_nowait()
+            except queue.Empty:
+                return
+            client = ppc.app().test_client()
+            for r in sequence:
+                start = time.time()
+                with db_stats.collect() as stats:
+                    res = _send(client, r)
+                elapsed = time.time() - start
+                with lock:
+                    samples.append(
+                        (_action(r), elapsed, stats, res.status_code))
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return _summarize(samples, time.time() - start)
+
+
+def _action(r):
+    """Action part of the path; the biv_uri varies by object"""
+    parts = r['path'].strip('/').split('/')
+    return '{} {}'.format(r['method'], parts[1] if len(parts) > 1 else 'index')
+
+
+def _percentile(values, p):
+    return values[max(0, int(math.ceil(p * len(values))) - 1)]
+
+
+def _request(method, path, json_data=None):
+    res = {'method': method, 'path': path, 'query': '', 'headers': {}}
+    if json_data is not None:
+        res['headers']['CONTENT_TYPE'] = 'application/json'
+        res['body'] = json.dumps(json_data).encode('utf-8')
+    return res
+
+
+def _send(client, r):
+    headers = {}
+    for k, v in r['headers'].items():
+        # The client's cookie jar holds this sequence's session
+        if k.startswith('HTTP_') and k != 'HTTP_COOKIE':
+            headers[k[5:].replace('_', '-').title()] = v
+    return client.open(
+        r['path'],
+        method=r['method'],
+        query_string=r['query'],
+        headers=headers,
+        content_type=r['headers'].get('CONTENT_TYPE'),
+        data=r.get('body') or recorder.body(r, 'request_body'),
+    )
+
+
+def _summarize(samples, elapsed):
+    by_action = collections.defaultdict(list)
+    for s in samples:
+        by_action[s[0]].append(s)
+    actions = {}
+    for action, ss in by_action.items():
+        latencies = sorted(s[1] for s in ss)
+        actions[action] = {
+            'count': len(ss),
+            'p50': _percentile(latencies, 0.50),
+            'p95': _percentile(latencies, 0.95),
+            'p99': _percentile(latencies, 0.99),
+            'queries': sum(s[2].count for s in ss) / len(ss),
+            'n_plus_one': sorted(set(
+                q for s in ss for q, _ in s[2].suspects())),
+            'throughput': len(ss) / elapsed if elapsed else 0,
+        }
+    return {
+        'actions': actions,
+        'count': len(samples),
+        'elapsed': elapsed,
+        'errors': sum(1 for s in samples if s[3] >= 500),
+        'throughput': len(samples) / elapsed if elapsed else 0,
+    }
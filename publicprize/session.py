@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+""" Session management replacement for the standard flask session.
+
+The store is selected by config.PUBLICPRIZE.SESSION_TYPE:
+
+    cookie: the session is signed and kept in the cookie (small payloads)
+    memory: uwsgi's shared cache if configured, else a per-process dict
+    database: the beaker_cache table (compatible with existing sessions)
+
+Sessions are read from the store on first access and only written, and the
+cookie only set, when they are modified.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import datetime
+import decimal
+import json
+import pickle
+import re
+import sys
+import threading
+import time
+import uuid
+
+import flask
+import flask.sessions
+import itsdangerous
+import sqlalchemy
+import werkzeug.datastructures
+
+from .debug import pp_t
+
+# the cookie key
+COOKIE_NAME = 'pp'
+
+
+class Session(werkzeug.datastructures.CallbackDict, flask.sessions.SessionMixin):
+    """Session values which track modification. The values are loaded
+    from the store on first access."""
+
+    def __init__(self, loader=None, persist=True):
+        def on_update(self):
+            self.modified = True
+        werkzeug.datastructures.CallbackDict.__init__(self, None, on_update)
+        self.is_loaded = False
+        self.modified = False
+        self.new = True
+        self.persist = persist
+        self.sid = None
+        self._loader = loader
+
+    def load(self):
+        """Loads the values from the store unless already loaded"""
+        if self.is_loaded:
+            return
+        self.is_loaded = True
+        if self._loader:
+            self.new, self.sid, data = self._loader()
+            if data:
+                dict.update(self, data)
+        pp_t('sid={} user_id={}', [self.sid, dict.get(self, 'user.biv_id')])
+
+
+class SessionInterface(flask.sessions.SessionInterface):
+    """Loads and saves Sessions in a store"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+        else:
+            self.store = None
+
+    def init_app(self, app):
+        """Register the session manager with flask."""
+        cfg = app.config['PUBLICPRIZE']
+        self.store = _STORES[cfg['SESSION_TYPE']](app, cfg['SESSION_TTL'])
+        app.session_interface = self
+
+    def open_session(self, app, request):
+        """Called by flask to create the session. Nothing is read until the
+        session is accessed. Bots get a session which is never saved."""
+        value = request.cookies.get(COOKIE_NAME)
+        if not value and _BOT_RE.search(request.headers.get('User-Agent', '')):
+            return Session(persist=False)
+
+        def loader():
+            data = self.store.load(value) if value else None
+            if data is None:
+                return True, self.store.new_sid(), None
+            return False, value, data
+
+        return Session(loader)
+
+    def save_session(self, app, session, response):
+        """Called by flask to save the session if it was modified"""
+        if not (session.modified and session.persist):
+            return
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(COOKIE_NAME, domain=domain, path=path)
+            return
+        pp_t('sid={}', [session.sid])
+        response.set_cookie(
+            COOKIE_NAME,
+            self.store.save(session.sid, dict(session)),
+            max_age=self.store.ttl,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+        )
+
+
+def _lazy(name):
+    method = getattr(werkzeug.datastructures.CallbackDict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in (
+    '__contains__', '__delitem__', '__getitem__', '__iter__', '__len__',
+    '__setitem__', 'clear', 'copy', 'get', 'items', 'keys', 'pop', 'popitem',
+    'setdefault', 'update', 'values',
+):
+    setattr(Session, _name, _lazy(_name))
+
+
+class _CookieStore(object):
+    """Session values are signed and stored in the cookie itself"""
+
+    def __init__(self, app, ttl):
+        self.ttl = ttl
+        self._serializer = itsdangerous.URLSafeTimedSerializer(
+            app.secret_key,
+            salt='pp-session',
+            serializer=_JSONSerializer(),
+        )
+
+    def delete(self, sid):
+        pass
+
+    def load(self, value):
+        try:
+            return self._serializer.loads(value, max_age=self.ttl)
+        except itsdangerous.BadSignature:
+            return None
+
+    def new_sid(self):
+        return None
+
+    def save(self, sid, data):
+        res = self._serializer.dumps(data)
+        if len(res) > _MAX_COOKIE_SIZE:
+            pp_t('session cookie size={}', [len(res)])
+        return res
+
+
+class _DatabaseStore(object):
+    """Session values are stored in the beaker_cache table (see
+    auth.model.BeakerCache) on the app's engine"""
+
+    def __init__(self, app, ttl):
+        self.ttl = ttl
+
+    def delete(self, sid):
+        self._execute('DELETE FROM beaker_cache WHERE namespace = :sid', sid=sid)
+
+    def load(self, sid):
+        if not _SID_RE.search(sid):
+            return None
+        row = self._execute(
+            '''SELECT data FROM beaker_cache
+            WHERE namespace = :sid AND accessed > :expires''',
+            sid=sid,
+            expires=datetime.datetime.now() - datetime.timedelta(seconds=self.ttl),
+        ).first()
+        if not row:
+            return None
+        return pickle.loads(row[0]).get('session')
+
+    def new_sid(self):
+        return _new_sid()
+
+    def save(self, sid, data):
+        self._execute(
+            '''INSERT INTO beaker_cache (namespace, accessed, created, data)
+            VALUES (:sid, :now, :now, :data)
+            ON CONFLICT (namespace)
+            DO UPDATE SET accessed = :now, data = :data''',
+            sid=sid,
+            now=datetime.datetime.now(),
+            data=pickle.dumps({'session': data}),
+        )
+        return sid
+
+    def _execute(self, stmt, **params):
+        # controller imports this module, so db isn't available at init
+        from . import controller
+        return controller.db.engine.execute(sqlalchemy.text(stmt), **params)
+
+
+class _JSONSerializer(object):
+    """JSON which preserves the Decimal and tuple values the app stores"""
+
+    def dumps(self, obj):
+        return json.dumps(_json_tag(obj), separators=(',', ':'))
+
+    def loads(self, value):
+        return json.loads(value, object_hook=_json_untag)
+
+
+class _MemoryStore(object):
+    """Session values are stored in uwsgi's cache (shared by workers) if
+    it is configured, else in this process."""
+
+    def __init__(self, app, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._uwsgi = None
+        # Only present when running under uwsgi (not our uwsgi.py)
+        uwsgi = sys.modules.get('uwsgi')
+        if hasattr(uwsgi, 'cache_update') \
+           and (uwsgi.opt.get('cache2') or uwsgi.opt.get('cache')):
+            self._uwsgi = uwsgi
+
+    def delete(self, sid):
+        if self._uwsgi:
+            self._uwsgi.cache_del(sid)
+            return
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def load(self, sid):
+        if not _SID_RE.search(sid):
+            return None
+        if self._uwsgi:
+            value = self._uwsgi.cache_get(sid)
+            return pickle.loads(value) if value else None
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if not entry:
+                return None
+            if entry[0] < time.monotonic():
+                del self._sessions[sid]
+                return None
+            return entry[1]
+
+    def new_sid(self):
+        return _new_sid()
+
+    def save(self, sid, data):
+        if self._uwsgi:
+            self._uwsgi.cache_update(sid, pickle.dumps(data), self.ttl)
+            return sid
+        with self._lock:
+            now = time.monotonic()
+            if len(self._sessions) >= _MAX_MEMORY_SESSIONS:
+                for k in [k for k, v in self._sessions.items() if v[0] < now]:
+                    del self._sessions[k]
+            self._sessions[sid] = (now + self.ttl, data)
+        return sid
+
+
+def _json_tag(value):
+    if isinstance(value, decimal.Decimal):
+        return {' d': str(value)}
+    if isinstance(value, tuple):
+        return {' t': [_json_tag(v) for v in value]}
+    if isinstance(value, list):
+        return [_json_tag(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _json_tag(v)) for k, v in value.items())
+    return value
+
+
+def _json_untag(obj):
+    if len(obj) == 1:
+        if ' d' in obj:
+            return decimal.Decimal(obj[' d'])
+        if ' t' in obj:
+            return tuple(obj[' t'])
+    return obj
+
+
+def _new_sid():
+    return uuid.uuid4().hex
+
+
+# Crawlers and link previewers which don't need sessions
+_BOT_RE = re.compile(
+    r'bot|crawl|spider|slurp|facebookexternalhit|embedly|preview',
+    re.IGNORECASE,
+)
+# Browsers drop cookies larger than 4K
+_MAX_COOKIE_SIZE = 4000
+# Expired entries are purged when the process holds this many sessions
+_MAX_MEMORY_SESSIONS = 100000
+_SID_RE = re.compile(r'^[0-9a-f]{32}$')
+_STORES = {
+    'cookie': _CookieStore,
+    'database': _DatabaseStore,
+    'memory': _MemoryStore,
+}
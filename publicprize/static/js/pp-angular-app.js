@@ -982,18 +982,52 @@ app.controller('AdminScoresController', function(serverRequest, contestState) {
     });
 });
 
-app.controller('AdminEventVotesController', function(serverRequest, contestState) {
+app.controller('AdminEventVotesController', function(serverRequest, $scope, $timeout) {
     var self = this;
-    function refreshList() {
-        serverRequest.sendRequest('/admin-event-votes', function(data) {
-            for (var p in data) {
-                if (data.hasOwnProperty(p)) {
-                    self[p] = data[p];
-                }
-            }
+    // milliseconds between refreshes of the vote counts
+    var POLL_INTERVAL = 2000;
+    var poller = null;
+    var isDestroyed = false;
+    self.votes = [];
+
+    function setCounts(data) {
+        ['contest', 'nominees', 'total_votes', 'total_votes_used'].forEach(function(p) {
+            self[p] = data[p];
         });
     }
-    refreshList();
+
+    function loadVotes(after) {
+        serverRequest.sendRequest(
+            '/admin-event-votes' + (after ? '?after=' + encodeURIComponent(after) : ''),
+            function(data) {
+                setCounts(data);
+                self.votes = self.votes.concat(data.votes);
+                if (data.after) {
+                    loadVotes(data.after);
+                }
+            });
+    }
+
+    function pollCounts() {
+        poller = $timeout(function() {
+            serverRequest.sendRequest(
+                '/admin-event-vote-counts',
+                function(data) {
+                    if (isDestroyed) {
+                        return;
+                    }
+                    setCounts(data);
+                    pollCounts();
+                });
+        }, POLL_INTERVAL);
+    }
+
+    loadVotes(null);
+    pollCounts();
+    $scope.$on('$destroy', function() {
+        isDestroyed = true;
+        $timeout.cancel(poller);
+    });
 });
 
 app.controller('AdminVotesController', function(serverRequest) {
@@ -48,3 +48,31 @@ def test_load_obj():
     assert biv.load_obj('_101').format_uri() == '/pub'
     assert biv.load_obj('').format_uri() == '/index'
     assert biv.load_obj('_101').format_uri('logout') == '/pub/logout'
+
+def test_alias_cache():
+    c = biv._AliasCache(2, 60)
+    assert c.get('a') == (False, None)
+    c.set('a', 1)
+    c.set('b', None)
+    assert c.get('b') == (True, None)
+    assert c.get('a') == (True, 1)
+    c.set('c', 3)
+    # 'a' was used more recently than 'b'
+    assert c.get('b') == (False, None)
+    assert c.get('a') == (True, 1)
+    c.discard('a')
+    assert c.get('a') == (False, None)
+    c = biv._AliasCache(2, -1)
+    c.set('a', 1)
+    assert c.get('a') == (False, None)
+
+def test_encode_uris():
+    biv.invalidate_alias('index', 4001)
+    biv._biv_id_alias_cache.set(13001, None)
+    biv._biv_id_alias_cache.set(14001, 'some-alias')
+    uris = biv.encode_uris([13001, 4001, 14001])
+    assert uris == ['_D01', 'index', 'some-alias']
+    assert [u.biv_id for u in uris] == [13001, 4001, 14001]
+    assert uris[0].biv_id.biv_marker == 1
+    assert uris[0].biv_id.biv_index == 13
+    biv.clear_alias_cache()
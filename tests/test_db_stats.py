@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+""" pytest for :mod:publicprize.db_stats
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import flask
+import sqlalchemy
+
+from publicprize import db_stats
+
+
+def test_request_stats():
+    app = flask.Flask(__name__)
+    app.config['PUBLICPRIZE'] = {'TEST_MODE': True}
+    db_stats.init(app)
+    engine = sqlalchemy.create_engine('sqlite://')
+
+    @app.route('/loop')
+    def loop():
+        with engine.connect() as c:
+            for i in range(db_stats.N_PLUS_ONE):
+                c.execute(sqlalchemy.text('SELECT :i'), {'i': i})
+        return ''
+
+    @app.route('/same')
+    def same():
+        with engine.connect() as c:
+            for i in range(db_stats.N_PLUS_ONE):
+                c.execute(sqlalchemy.text('SELECT 1'))
+        return ''
+
+    client = app.test_client()
+    res = client.get('/loop')
+    assert res.headers['X-PP-DB'].startswith(
+        'queries={}; '.format(db_stats.N_PLUS_ONE))
+    assert res.headers['X-PP-DB'].endswith('n_plus_one=1')
+    with db_stats.collect() as stats:
+        res = client.get('/same')
+    assert res.headers['X-PP-DB'].endswith('n_plus_one=0')
+    assert stats.count == db_stats.N_PLUS_ONE
+    assert stats.suspects() == []
+
+
+def test_teardown_counted():
+    app = flask.Flask(__name__)
+    app.config['PUBLICPRIZE'] = {'TEST_MODE': False}
+    db_stats.init(app)
+    engine = sqlalchemy.create_engine('sqlite://')
+    logged = []
+
+    # Registered after init like SQLAlchemy's teardown (commit)
+    @app.teardown_appcontext
+    def _commit(exc):
+        with engine.connect() as c:
+            c.execute(sqlalchemy.text('SELECT 2'))
+
+    @app.route('/one')
+    def one():
+        with engine.connect() as c:
+            c.execute(sqlalchemy.text('SELECT 1'))
+        return ''
+
+    app.logger.info = logged.append
+    app.test_client().get('/one')
+    assert len(logged) == 1
+    assert '"queries": 2' in logged[0]
+    assert '"path": "/one"' in logged[0]
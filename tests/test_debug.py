@@ -5,28 +5,38 @@
     :license: Apache, see LICENSE for more details.
 """
 
-import glob
+import hashlib
+import hmac
 import inspect
+import io
+import json
 import os.path
 import pytest
 import re
 import shutil
 
 from publicprize import debug as ppd
+from publicprize import recorder
 from publicprize import config
 from publicprize.debug import pp_t
 
 _request_logger = None
 
 _expect = {
-    'environ': 'some environ',
-    'status': 'some status',
-    'response_headers': 'some headers',
-    'response_data': 'some write',
+    'environ': {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/some/path',
+        'HTTP_USER_AGENT': 'some agent',
+        'CONTENT_LENGTH': '9',
+    },
+    'request_body': b'some body',
+    'status': '200 OK',
+    'response_headers': [['Content-Type', 'text/plain']],
+    'response_data': [b'some ', b'write'],
     'other': 'hello'
 }
 
-def _init_debug(test_mode, regex):
+def _init_debug(test_mode, regex, modules=None):
     ppd._request_logger = None
     ppd._trace_printer = None
     ppd._app = None
@@ -34,6 +44,7 @@ def _init_debug(test_mode, regex):
     mock.config = {
         'PUBLICPRIZE': {
             'TRACE': regex,
+            'TRACE_MODULES': modules,
             'TEST_MODE': test_mode}}
     ppd.init(mock)
     return mock
@@ -48,6 +59,7 @@ class MockApp(object):
         global _expect
         global _request_logger
         self.called__call__ += 1
+        assert environ['wsgi.input'].read() == _expect['request_body']
         start_response(_expect['status'], _expect['response_headers'])
         return _expect['response_data']
 
@@ -68,32 +80,141 @@ def test_log():
     def start_response(status, response_headers, exc_info=None):
         nonlocal called_start_response
         called_start_response += 1
-    
-    def assert_file(index, suffix):
-        name = os.path.join('debug', index + '-' + suffix)
-        assert os.path.exists(name), name
-        with open(name, 'r') as f:
-            actual = f.read()
-            assert actual == _expect[suffix], suffix + '=' + actual
-
-    response = mock.wsgi_app(_expect['environ'], start_response)
-    assert '00000003-response_headers' in _request_logger.last_file_name()
-    _request_logger.set_log_dir('new_dir')
+
+    environ = dict(_expect['environ'])
+    environ['wsgi.input'] = io.BytesIO(_expect['request_body'])
+    response = mock.wsgi_app(environ, start_response)
     for ignore in response:
         pass
-    assert '00000001-response_data' in _request_logger.last_file_name() 
     response.close()
     _request_logger.log('hello', 'other')
-
     assert mock.called__call__ == 1
     assert called_start_response == 1
-    assert_file('00000001', 'environ')
-    assert_file('00000002', 'status')
-    assert_file('00000003', 'response_headers')
-    assert_file('new_dir/00000001', 'response_data')
-    assert_file('new_dir/00000002', 'other')
-    _request_logger.log('not written', 'invalid/suffix')
-    assert list(glob.glob('debug/*invalid*')) == [], 'found invalid/suffix'
+    assert os.path.join('debug', 'requests.log') in _request_logger.last_file_name()
+    r, other = list(recorder.read(_request_logger.last_file_name()))
+    assert r['method'] == 'POST'
+    assert r['path'] == '/some/path'
+    assert r['headers']['HTTP_USER_AGENT'] == 'some agent'
+    assert recorder.body(r, 'request_body') == _expect['request_body']
+    assert r['status'] == _expect['status']
+    assert r['response_headers'] == _expect['response_headers']
+    assert recorder.body(r, 'response_body') == b'some write'
+    assert other == {'suffix': 'other', 'data': _expect['other']}
+
+    _request_logger.set_log_dir('new_dir')
+    _request_logger.log('hello', 'other')
+    assert os.path.join('debug', 'new_dir', 'requests.log') in _request_logger.last_file_name()
+    assert len(list(recorder.read(_request_logger.last_file_name()))) == 1
+
+
+def test_recorder_rotate_and_sample(tmpdir):
+    path = str(tmpdir.join('r.log'))
+    r = recorder.Recorder(None, path, max_bytes=100, backup_count=2, is_sync=True)
+    for i in range(5):
+        r.write({'data': 'x' * 100, 'i': i})
+    assert [x['i'] for x in recorder.read(path + '.1')] == [4]
+    assert [x['i'] for x in recorder.read(path + '.2')] == [3]
+    assert not os.path.exists(path + '.3')
+    called = []
+    r = recorder.Recorder(lambda e, s: called.append(1) or [], path, sample=0)
+    assert r({}, None) == []
+    assert called == [1]
+
+
+def test_recorder_per_process(tmpdir):
+    path = str(tmpdir.join('r.log'))
+    r = recorder.Recorder(
+        None, path, max_bytes=100, backup_count=1, is_sync=True,
+        per_process=True,
+    )
+    for i in range(2):
+        r.write({'data': 'x' * 100, 'i': i})
+    p = '{}.{}'.format(path, os.getpid())
+    assert [x['i'] for x in recorder.read(p + '.1')] == [1]
+    assert not os.path.exists(path)
+
+
+def test_recorder_init_and_truncate(tmpdir):
+    path = str(tmpdir.join('r.log'))
+    app = MockApp()
+    app.config = {'PUBLICPRIZE': {'RECORD_FILE': path, 'RECORD_SAMPLE': 0}}
+    recorder.init(app)
+    assert app.wsgi_app.sample == 0
+    app.wsgi_app = app
+    app.config['PUBLICPRIZE']['RECORD_SAMPLE'] = None
+    recorder.init(app)
+    assert app.wsgi_app.sample == 1
+
+    body = b'x' * 10 + b'\n' + b'y' * 10
+    read = []
+
+    def _app(environ, start_response):
+        read.append(environ['wsgi.input'].readline())
+        read.append(environ['wsgi.input'].read())
+        start_response('200 OK', [])
+        return [b'abcde', b'fghij']
+
+    r = recorder.Recorder(_app, path, max_body=8, is_sync=True)
+    res = r(
+        {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        },
+        lambda *args: None,
+    )
+    list(res)
+    res.close()
+    x = list(recorder.read(path))[-1]
+    assert b''.join(read) == body
+    assert recorder.body(x, 'request_body') == body[:8]
+    assert x['request_truncated']
+    assert recorder.body(x, 'response_body') == b'abcdefgh'
+    assert x['response_truncated']
+
+
+def test_recorder_redact(tmpdir):
+    path = str(tmpdir.join('r.log'))
+
+    def _app(environ, start_response):
+        environ['wsgi.input'].read()
+        start_response('200 OK', [('Set-Cookie', 'session=s1')])
+        return [b'ok']
+
+    def _record(content_type, body):
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/login',
+            'HTTP_COOKIE': 'session=s1',
+            'HTTP_AUTHORIZATION': 'Basic dTpw',
+            'HTTP_USER_AGENT': 'some agent',
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        res = r(environ, lambda *args: None)
+        list(res)
+        res.close()
+        return list(recorder.read(path))[-1]
+
+    r = recorder.Recorder(
+        _app, path, is_sync=True, session_cookie='session', secret_key='k')
+    x = _record('application/x-www-form-urlencoded', b'user=a&password=b')
+    assert x['headers']['HTTP_COOKIE'] == '<redacted>'
+    assert x['session_key'] \
+        == hmac.new(b'k', b's1', hashlib.sha256).hexdigest()
+    assert x['headers']['HTTP_AUTHORIZATION'] == '<redacted>'
+    assert x['headers']['HTTP_USER_AGENT'] == 'some agent'
+    assert x['response_headers'] == [['Set-Cookie', '<redacted>']]
+    assert recorder.body(x, 'request_body') \
+        == b'user=a&password=%3Credacted%3E'
+    x = _record('application/json', b'{"a": {"api_token": "t"}, "b": 1}')
+    assert json.loads(recorder.body(x, 'request_body').decode('utf-8')) \
+        == {'a': {'api_token': '<redacted>'}, 'b': 1}
+    body = b'{"nominee": "x"}'
+    assert recorder.body(_record('application/json', body), 'request_body') \
+        == body
+
 
 def test_trace():
     _last_msg = None
@@ -126,3 +247,21 @@ def test_trace():
     pp_t('goodbye')
     assert expect('goodbye') == _last_msg 
     
+
+def test_trace_modules():
+    msgs = []
+    def _init(modules):
+        msgs.clear()
+        _init_debug(0, '.', modules)
+        ppd._trace_printer.write = msgs.append
+
+    _init('^publicprize')
+    pp_t('hello')
+    assert [] == msgs
+
+    _init(r'^(tests\.)?test_debug$')
+    for i in range(2):
+        pp_t('hello{}', [i])
+    assert 2 == len(msgs)
+    assert msgs[0].endswith(':test_trace_modules hello0\n')
+    assert len(ppd._trace_printer._sites) == 1
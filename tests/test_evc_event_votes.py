@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+""" Event vote tally and admin_event_votes paging. Runs against the test
+database (manage.py create_test_db) and rolls back its changes.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import unittest
+
+import publicprize.controller as ppc
+from publicprize import biv
+from publicprize.auth import model as pam
+from publicprize.evc import model as pem
+
+_VOTERS = ['event-voter{}@example.com'.format(i) for i in (3, 1, 2)]
+
+
+class EventVotesTestCase(unittest.TestCase):
+    def setUp(self):
+        ppc.init()
+        self.context = ppc.app().test_request_context()
+        self.context.push()
+        self.contest = pem.E15Contest.query.first()
+        self.finalists = pem.E15Nominee.query.select_from(pam.BivAccess).filter(
+            pam.BivAccess.source_biv_id == self.contest.biv_id,
+            pam.BivAccess.target_biv_id == pem.E15Nominee.biv_id,
+        ).order_by(pem.E15Nominee.biv_id).limit(2).all()
+        for n in self.finalists:
+            n.is_finalist = True
+        ppc.db.session.flush()
+        self._reset()
+        pem.E15VoteAtEvent.create_many(self.contest, _VOTERS)
+
+    def tearDown(self):
+        ppc.db.session.rollback()
+        self._reset()
+        self.context.pop()
+
+    def test_paging(self):
+        all_emails = [
+            r[0] for r in ppc.db.session.query(
+                pem.E15VoteAtEvent.invite_email_or_phone,
+            ).filter_by(
+                contest_biv_id=self.contest.biv_id,
+            ).order_by(pem.E15VoteAtEvent.invite_email_or_phone)
+        ]
+        emails = []
+        after = None
+        while True:
+            res = self.contest.admin_event_votes(after=after, limit=2)
+            assert 1 <= len(res['votes']) <= 2
+            for v in res['votes']:
+                assert biv.URI(v['biv_id']).biv_id.biv_marker \
+                    == pem.E15VoteAtEvent.BIV_MARKER
+                emails.append(v['invite_email_or_phone'])
+            after = res['after']
+            if not after:
+                break
+            assert after == res['votes'][-1]['biv_id']
+        assert emails == all_emails
+        res = self.contest.admin_event_votes(limit=pem._EVENT_VOTES_PAGE + 1)
+        assert len(res['votes']) == min(len(all_emails), pem._EVENT_VOTES_PAGE)
+
+    def test_tally(self):
+        c = self.contest
+        nominee_id = int(self.finalists[0].biv_id)
+        t = pem.E15EventTally.get(c.biv_id)
+        total = t.total
+        assert total >= len(_VOTERS)
+        entry = pem.E15VoterIndex.get(c.biv_id).by_nonce[
+            self._voter(_VOTERS[0]).invite_nonce]
+        assert pem.E15VoteAtEvent.vote(entry, nominee_id, None, 'agent', '')
+        # The caches are updated when the transaction commits
+        assert t.counts.get(nominee_id, 0) == 0
+        assert not pem.E15VoteAtEvent.vote(entry, nominee_id, None, 'agent', '')
+        # The test's changes are rolled back, so call the commit hook
+        pem._add_event_votes_after_commit(ppc.db.session)
+        assert t.counts[nominee_id] == 1
+        index = pem.E15VoterIndex.get(c.biv_id)
+        assert index.by_biv_id[entry.biv_id].nominee_biv_id == nominee_id
+        # Rebuilt from the database
+        pem._event_tallies.clear()
+        res = c.event_vote_counts()
+        assert res['total_votes'] == total
+        counts = dict((n['display_name'], n['count']) for n in res['nominees'])
+        assert counts[self.finalists[0].display_name] == 1
+
+    def test_vote_rollback(self):
+        c = self.contest
+        nominee_id = int(self.finalists[0].biv_id)
+        t = pem.E15EventTally.get(c.biv_id)
+        entry = pem.E15VoterIndex.get(c.biv_id).by_nonce[
+            self._voter(_VOTERS[0]).invite_nonce]
+        assert pem.E15VoteAtEvent.vote(entry, nominee_id, None, 'agent', '')
+        ppc.db.session.rollback()
+        assert pem._EVENT_VOTES not in ppc.db.session.info
+        assert t.counts.get(nominee_id, 0) == 0
+        assert pem.E15VoterIndex.get(c.biv_id).by_biv_id[entry.biv_id] \
+            .nominee_biv_id is None
+
+    def _reset(self):
+        pem.invalidate_snapshot(self.contest.biv_id)
+        pem._event_tallies.clear()
+        pem._voter_indexes.clear()
+
+    def _voter(self, email):
+        return pem.E15VoteAtEvent.query.filter_by(
+            contest_biv_id=self.contest.biv_id,
+            invite_email_or_phone=email,
+        ).one()
+
+
+if __name__ == '__main__':
+    unittest.main()
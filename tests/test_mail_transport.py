@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+""" pytest for :mod:publicprize.mail_transport
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import flask
+import flask_mail
+
+from publicprize import mail_transport as mt
+
+
+def _message(i):
+    return flask_mail.Message(
+        subject='subject {}'.format(i),
+        sender='support@example.com',
+        recipients=['voter{}@example.com'.format(i)],
+        body='.line starting with a dot\n',
+    )
+
+
+def test_pool():
+    with mt.Sink() as sink:
+        app = flask.Flask(__name__)
+        app.config.update(
+            MAIL_SERVER='127.0.0.1',
+            MAIL_PORT=sink.port,
+            MAIL_USERNAME='user',
+            MAIL_PASSWORD='pass',
+        )
+        pool = mt.Pool(flask_mail.Mail(app), size=1)
+        with app.app_context():
+            pool.send_many([_message(i) for i in range(3)])
+            pool.send(_message(3))
+            assert sink.connections == 1
+            # Server closed the idle connection
+            pool._idle[0][1].host.close()
+            pool.send(_message(4))
+        assert pool.stats == dict(opened=2, reconnects=1, sent=5)
+        assert sink.connections == 2
+        assert [m['recipients'] for m in sink.messages] \
+            == [['voter{}@example.com'.format(i)] for i in range(5)]
+        assert sink.messages[0]['sender'] == 'support@example.com'
+        assert b'\r\n.line starting with a dot' in sink.messages[0]['data']
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+""" pytest for :mod:publicprize.session
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import decimal
+
+import flask
+import pytest
+
+from publicprize import debug as ppd
+from publicprize import session as pps
+
+_DATA = {
+    'user.biv_id': decimal.Decimal('100001'),
+    'user.is_logged_in': True,
+    'oauth.google.token': ('abc', ''),
+}
+
+
+class MockApp(object):
+
+    def __init__(self):
+        self.wsgi_app = self
+
+
+def setup_module(module):
+    if ppd._trace_printer:
+        return
+    mock = MockApp()
+    mock.config = {
+        'PUBLICPRIZE': {
+            'TRACE': None,
+            'TEST_MODE': 0}}
+    ppd.init(mock)
+
+
+def test_cookie_store():
+    store = pps._CookieStore(_app('cookie'), 60)
+    value = store.save(None, _DATA)
+    assert store.load(value) == _DATA
+    assert store.load(value[:-2]) is None
+
+
+def test_memory_store():
+    store = pps._MemoryStore(_app('memory'), 60)
+    sid = store.new_sid()
+    store.save(sid, _DATA)
+    assert store.load(sid) == _DATA
+    assert store.load(store.new_sid()) is None
+    assert store.load('not-a-sid') is None
+    store.delete(sid)
+    assert store.load(sid) is None
+
+
+@pytest.mark.parametrize('session_type', ['cookie', 'memory'])
+def test_save_when_modified(session_type):
+    app = _app(session_type)
+
+    @app.route('/read')
+    def read():
+        return str(flask.session.get('user.biv_id'))
+
+    @app.route('/write')
+    def write():
+        flask.session['user.biv_id'] = _DATA['user.biv_id']
+        return ''
+
+    client = app.test_client()
+    res = client.get('/read')
+    assert 'Set-Cookie' not in res.headers
+    res = client.get('/write')
+    assert pps.COOKIE_NAME + '=' in res.headers['Set-Cookie']
+    res = client.get('/read')
+    assert 'Set-Cookie' not in res.headers
+    assert res.data == b'100001'
+
+
+def test_lazy_load():
+    app = _app('memory')
+    loads = []
+    store = app.session_interface.store
+    store_load = store.load
+    store.load = lambda sid: loads.append(sid) or store_load(sid)
+
+    @app.route('/static-like')
+    def static_like():
+        return ''
+
+    @app.route('/write')
+    def write():
+        flask.session['user.is_logged_in'] = True
+        return ''
+
+    client = app.test_client()
+    client.get('/write')
+    res = client.get('/static-like')
+    assert 'Set-Cookie' not in res.headers
+    assert not loads
+    client.get('/write')
+    assert len(loads) == 1
+
+
+def test_bot():
+    app = _app('memory')
+
+    @app.route('/write')
+    def write():
+        flask.session['user.is_logged_in'] = True
+        return ''
+
+    res = app.test_client().get(
+        '/write',
+        headers={'User-Agent': 'Mozilla/5.0 (compatible; Googlebot/2.1)'},
+    )
+    assert 'Set-Cookie' not in res.headers
+
+
+def _app(session_type):
+    app = flask.Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['PUBLICPRIZE'] = {
+        'SESSION_TTL': 60,
+        'SESSION_TYPE': session_type,
+    }
+    pps.SessionInterface(app)
+    return app
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+""" pytest for :mod:publicprize.contest.vote_queue. Runs against the test
+database (manage.py create_test_db); the writer commits, so the users and
+votes created are deleted afterwards.
+
+    :copyright: Copyright (c) 2017 Bivio Software, Inc.  All Rights Reserved.
+    :license: Apache, see LICENSE for more details.
+"""
+
+import queue
+import threading
+import unittest
+import uuid
+
+import werkzeug.exceptions
+
+import publicprize.controller as ppc
+from publicprize.auth import model as pam
+from publicprize.contest import model as pcm
+from publicprize.contest import vote_queue as pcvq
+from publicprize.evc import model as pem
+
+# Not in user_t, so the vote violates the foreign key
+_MISSING_USER = 999999999999999999
+
+
+class VoteQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        ppc.init()
+        self.context = ppc.app().app_context()
+        self.context.push()
+        self.contest = pem.E15Contest.query.first()
+        self.nominee = pem.E15Nominee.query.select_from(pam.BivAccess).filter(
+            pam.BivAccess.source_biv_id == self.contest.biv_id,
+            pam.BivAccess.target_biv_id == pem.E15Nominee.biv_id,
+        ).first()
+        self.users = []
+        for i in range(5):
+            u = pam.User(
+                display_name='Vote Queue {}'.format(i),
+                user_email='vote-queue{}@localhost'.format(i),
+                oauth_type='test',
+                oauth_id=str(uuid.uuid1()),
+            )
+            ppc.db.session.add(u)
+            self.users.append(u)
+        ppc.db.session.commit()
+        self.user_ids = [u.biv_id for u in self.users]
+        self.saved = dict(
+            (k, getattr(pcvq, k))
+            for k in ('_BATCH_WAIT', '_COMMIT_TIMEOUT', '_writer_queue')
+        )
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(pcvq, k, v)
+        ppc.db.session.rollback()
+        pcm.Vote.query.filter(pcm.Vote.user.in_(self.user_ids)).delete(
+            synchronize_session=False)
+        pam.User.query.filter(pam.User.biv_id.in_(self.user_ids)).delete(
+            synchronize_session=False)
+        ppc.db.session.commit()
+        ppc.db.session.remove()
+        self.context.pop()
+
+    def test_batch(self):
+        # Long enough for every submit to join the writer's batch
+        pcvq._BATCH_WAIT = 0.5
+        before = pcvq.stats()
+        res = {}
+
+        def _submit(user_biv_id):
+            with ppc.app().app_context():
+                res[user_biv_id] = self._submit(user_biv_id)
+
+        threads = [
+            threading.Thread(target=_submit, args=(u,)) for u in self.user_ids
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        after = pcvq.stats()
+        assert list(res.values()) == [True] * len(self.user_ids)
+        assert after['batches'] - before['batches'] == 1
+        assert after['last_batch_size'] == len(self.user_ids)
+        assert after['written'] - before['written'] == len(self.user_ids)
+        assert self._votes() == len(self.user_ids)
+        # ON CONFLICT skips a second vote in the contest
+        assert not self._submit(self.user_ids[0])
+        assert pcvq.stats()['rejected'] - after['rejected'] == 1
+        assert self._votes() == len(self.user_ids)
+
+    def test_failed_batch(self):
+        good = pcvq._Item(
+            self.contest.biv_id, self.user_ids[0], self.nominee.biv_id, {})
+        bad = pcvq._Item(
+            self.contest.biv_id, _MISSING_USER, self.nominee.biv_id, {})
+        before = pcvq.stats()
+        pcvq._flush([good, bad])
+        assert pcvq.stats()['failed_batches'] - before['failed_batches'] == 1
+        assert good.was_written and good.error is None
+        assert not bad.was_written and bad.error is not None
+        assert good.done.is_set() and bad.done.is_set()
+        assert self._votes() == 1
+
+    def test_queue_full(self):
+        full = queue.Queue(maxsize=1)
+        full.put(None)
+        pcvq._writer_queue = lambda: full
+        before = pcvq.stats()
+        assert self._submit(self.user_ids[0])
+        # Written in the request's transaction
+        ppc.db.session.commit()
+        assert pcvq.stats()['sync_writes'] - before['sync_writes'] == 1
+        assert self._votes() == 1
+
+    def test_timeout(self):
+        # No writer reads the queue
+        q = queue.Queue()
+        pcvq._writer_queue = lambda: q
+        pcvq._COMMIT_TIMEOUT = 0.01
+        with self.assertRaises(werkzeug.exceptions.ServiceUnavailable):
+            self._submit(self.user_ids[0])
+        assert q.qsize() == 1
+        # The user may retry
+        with pcvq._lock:
+            assert not pcvq._pending
+
+    def _submit(self, user_biv_id):
+        return pcvq.submit(
+            self.contest.biv_id, user_biv_id, self.nominee.biv_id, {})
+
+    def _votes(self):
+        return pcm.Vote.query.filter(
+            pcm.Vote.user.in_(self.user_ids),
+        ).count()
+
+
+if __name__ == '__main__':
+    unittest.main()